@@ -3,14 +3,24 @@
 
 import os
 import sys
+import glob
+import hashlib
+import argparse
+import socketserver
+from dictrie import Trie
+from fileutil import cachedir
 
 '''
 Clone of WWStar, an ancient Classical Chinese translator.
 
-usage: python3 WWStarClone.py [dir]
+usage: python3 WWStarClone.py [-s [HOST:]PORT] [-n] [dir]
 `dir` should be the root directory of WWStar, which contains a
 `Script` directory.
 
+The merged dictionary is compiled to a memory-mapped trie in the cache
+directory, which is rebuilt when VERSION.DAT or the dictionary files change.
+With -s, translate lines sent to a TCP port instead of stdin.
+
 Copyright (c) 2016 gumblex
 
 This program is free software. It comes without any warranty, to
@@ -21,19 +31,67 @@ http://www.wtfpl.net/ for more details.
 '''
 
 class WWStarEngine:
-    def __init__(self, path):
+    def __init__(self, path, cache=True):
         self.datadir = os.path.join(path, 'Script')
-        self.d = {}
+        # word -> translation; None until needed if loaded from the cache
+        self._d = {}
         self.maxlen = 1
-        self.version = open(os.path.join(self.datadir, 'VERSION.DAT'), 'r', encoding='gbk').read().splitlines()
+        self.trie = None
+        versionfile = os.path.join(self.datadir, 'VERSION.DAT')
+        self.version = open(versionfile, 'r', encoding='gbk').read().splitlines()
         prefix = self.version[4]
-        for fn in sorted(os.listdir(self.datadir)):
-            if fn.lower().startswith(prefix.lower()) and fn[-1].isdigit():
-                # ignore WWS.RT
-                self.load_file(os.path.join(self.datadir, fn))
+        # ignore WWS.RT
+        self.files = [os.path.join(self.datadir, fn) for fn in sorted(os.listdir(self.datadir))
+                      if fn.lower().startswith(prefix.lower()) and fn[-1].isdigit()]
+        cachefile = self.cachefile([versionfile] + self.files) if cache else None
+        if cachefile:
+            try:
+                self.trie = Trie.load(cachefile)
+                self.maxlen = max(self.trie.maxlen, 1)
+                self._d = None
+                return
+            except (OSError, ValueError):
+                pass
+        for fn in self.files:
+            self.load_file(fn)
+        if cachefile:
+            self.trie = Trie.build(self._d)
+            for fn in glob.glob(cachefile.rsplit('.', 2)[0] + '.*.trie'):
+                try:
+                    os.unlink(fn)
+                except OSError:
+                    pass
+            try:
+                self.trie.save(cachefile)
+            except OSError:
+                pass
+
+    def cachefile(self, files):
+        '''Name of the compiled dictionary, from the sizes and mtimes of `files`.'''
+        dirhash = hashlib.sha1(os.path.abspath(self.datadir).encode('utf-8', 'surrogateescape'))
+        stamp = hashlib.sha1()
+        for fn in files:
+            st = os.stat(fn)
+            stamp.update(('%s\t%d\t%d\n' % (os.path.basename(fn), st.st_size, st.st_mtime_ns)).encode('utf-8', 'surrogateescape'))
+        return os.path.join(cachedir(), 'wwstar.%s.%s.trie' % (
+            dirhash.hexdigest()[:16], stamp.hexdigest()[:16]))
+
+    @property
+    def d(self):
+        '''The dictionary of words to translations. Call `reload` after changing it.'''
+        if self._d is None:
+            self._d = dict(self.trie.items())
+        return self._d
+
+    def reload(self):
+        '''Rebuild the trie from `d` for the next translation.'''
+        d = self.d
+        self.trie = None
+        return d
 
     def load_file(self, filename):
         word_len = int(filename[-1])
+        d = self.reload()
         with open(filename, 'r', encoding='gbk') as f:
             while 1:
                 s = f.readline()
@@ -41,38 +99,67 @@ class WWStarEngine:
                 if s and t:
                     s = s.strip()
                     # makes the behavior for conflict phrases the same as WWStar
-                    if len(s) == word_len and s not in self.d:
-                        self.d[s] = t.strip()
+                    if len(s) == word_len and s not in d:
+                        d[s] = t.strip()
                     self.maxlen = max(self.maxlen, len(s))
                 else:
                     break
 
     def translate(self, sentence):
-        n = len(sentence)
-        pos = 0
-        while pos < n:
-            i = pos
-            frag = sentence[pos]
-            maxword = None
-            maxpos = 0
-            while i < n and i < pos + self.maxlen:
-                if frag in self.d:
-                    maxword = frag
-                    maxpos = i
-                i += 1
-                frag = sentence[pos:i+1]
-            if maxword is None:
-                yield sentence[pos]
-                pos += 1
+        if self.trie is None:
+            self.trie = Trie.build(self._d)
+        value = self.trie.value
+        for start, end, node in self.trie.segment(sentence):
+            if node < 0:
+                yield sentence[start]
             else:
-                yield self.d[maxword]
-                pos = maxpos + 1
+                yield value(node)
+
+    def translate_many(self, sentences):
+        '''Yields the translation of each of `sentences`.'''
+        if self.trie is None:
+            self.trie = Trie.build(self._d)
+        value = self.trie.value
+        for sentence, segments in self.trie.segmentmany(sentences):
+            yield ''.join(sentence[start] if node < 0 else value(node)
+                          for start, end, node in segments)
+
+class TranslateHandler(socketserver.StreamRequestHandler):
+    '''Translates each line sent, in UTF-8.'''
+
+    def handle(self):
+        translate = self.server.engine.translate
+        for ln in self.rfile:
+            ln = ln.decode('utf-8', 'replace').rstrip()
+            self.wfile.write((''.join(translate(ln)) + '\n').encode('utf-8'))
+
+class TranslateServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, engine):
+        self.engine = engine
+        socketserver.TCPServer.__init__(self, address, TranslateHandler)
+
+def main():
+    parser = argparse.ArgumentParser(description="Clone of WWStar, an ancient Classical Chinese translator.")
+    parser.add_argument("-s", "--serve", metavar="[HOST:]PORT", help="translate lines sent to this TCP port")
+    parser.add_argument("-n", "--no-cache", action="store_true", help="don't use the compiled dictionary cache")
+    parser.add_argument("dir", nargs="?", default=".", help="WWStar root directory (default: .)")
+    args = parser.parse_args()
+    te = WWStarEngine(args.dir, not args.no_cache)
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        server = TranslateServer((host or 'localhost', int(port)), te)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+    for ln in te.translate_many(ln.rstrip() for ln in sys.stdin):
+        print(ln)
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        path = '.'
-    else:
-        path = sys.argv[1]
-    te = WWStarEngine(path)
-    for ln in sys.stdin:
-        print(''.join(te.translate(ln.rstrip())))
+    main()
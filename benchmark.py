@@ -0,0 +1,722 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+import collections
+import tracemalloc
+
+'''
+Benchmarks for the hot functions and scripts in this repository.
+
+    python3 benchmark.py run [-s SCALE] [-o FILE] [-b BASELINE] [NAME ...]
+    python3 benchmark.py gen KIND [-n LINES]
+    python3 benchmark.py list
+
+`run` generates deterministic synthetic data, runs the benchmarks (all of
+them, or the ones whose name starts with one of NAME) and reports
+throughput in lines/s and MB/s, plus peak memory: traced Python memory for
+functions, max RSS for scripts. Results are saved as JSON and compared
+against a baseline from an earlier run.
+'''
+
+_curpath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _curpath)
+
+### Synthetic data
+
+CLASSICAL = ('之', '乎', '者', '也', '矣', '焉', '哉', '曰', '其', '而', '則',
+             '乃', '夫', '吾', '爾', '子', '王', '君子', '天下', '不可', '何以',
+             '是故', '於是', '所以', '無', '有', '聖人', '百姓', '先王', '仁義')
+MODERN = ('我们', '他们', '的', '了', '是', '在', '这个', '那个', '什么', '因为',
+          '所以', '可以', '没有', '时候', '知道', '现在', '已经', '自己', '一个',
+          '问题', '我', '你', '他', '说', '就', '都', '要', '会', '还是', '觉得')
+EXTRA = ('ＡＢＣ', '１２３', 'iPhone', 'OK', ' ', '　', '（注）', '《史记》')
+USERCHARS = 'abcdefghijklmnopqrstuvwxyz0123456789_.'
+PWDCHARS = USERCHARS + 'ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&* '
+DOMAINS = ('qq.com', '163.com', 'gmail.com', 'sina.com.cn', 'yahoo.com')
+
+
+def _sentence(rnd, words):
+    clauses = []
+    for i in range(rnd.randint(1, 3)):
+        clause = []
+        for j in range(rnd.randint(2, 8)):
+            r = rnd.random()
+            if r < .03:
+                clause.append(rnd.choice(EXTRA))
+            elif r < .05:
+                clause.append(str(rnd.randint(0, 10 ** rnd.randint(1, 9))))
+            else:
+                clause.append(rnd.choice(words))
+        clauses.append(clause)
+    end = rnd.choice('。。。！？')
+    if rnd.random() < .2:
+        # quoted speech
+        return [rnd.choice(words), '说', '：', '“'] + sum(
+            (c + ['，'] for c in clauses), [])[:-1] + [end, '”']
+    return sum((c + ['，'] for c in clauses), [])[:-1] + [end]
+
+
+def gen_zhwords(n, seed=0):
+    '''Paragraphs of mixed classical/modern Chinese as lists of words.'''
+    rnd = random.Random(seed)
+    for i in range(n):
+        words = CLASSICAL if rnd.random() < .5 else MODERN
+        yield sum((_sentence(rnd, words) for j in range(rnd.randint(1, 6))), [])
+
+
+def gen_zhtext(n, seed=0):
+    '''Lines of mixed classical/modern Chinese text.'''
+    for words in gen_zhwords(n, seed):
+        yield ''.join(words) + '\n'
+
+
+def gen_tokens(n, seed=0):
+    '''Whitespace-tokenized lines of Chinese text.'''
+    for words in gen_zhwords(n, seed):
+        yield ' '.join(w for w in words if w.strip()) + '\n'
+
+
+def gen_dump(n, seed=0):
+    '''Dirty lines of leaked account dumps, as bytes.'''
+    rnd = random.Random(seed)
+    rstr = lambda chars, a, b: ''.join(
+        rnd.choice(chars) for i in range(rnd.randint(a, b)))
+    for i in range(n):
+        user = rstr(USERCHARS, 3, 12)
+        pwd = rstr(PWDCHARS, 6, 14).strip() or '123456'
+        email = '%s@%s' % (user, rnd.choice(DOMAINS))
+        md5 = hashlib.md5(pwd.encode('ascii')).hexdigest()
+        r = rnd.random()
+        if r < .3:
+            ln = '%s----%s' % (email, pwd)
+        elif r < .5:
+            ln = '%s|%s|%s' % (user, md5, email)
+        elif r < .65:
+            ln = '%s\t%s\t%s' % (user, pwd, email)
+        elif r < .75:
+            ln = '%s,%s' % (user, pwd)
+        elif r < .85:
+            ln = '%s %s  %s' % (rstr(MODERN, 1, 3), email, md5)
+        elif r < .95:
+            ln = '%s----%s' % (user, pwd)
+        else:
+            ln = rstr(PWDCHARS + '\x01\x1f', 0, 40)
+        yield ln.encode('gbk' if r > .8 else 'utf-8') + b'\n'
+
+
+def gen_records(n, seed=0):
+    '''simpdump.py output: username, email, password and md5, as bytes.'''
+    rnd = random.Random(seed)
+    rstr = lambda chars, a, b: ''.join(
+        rnd.choice(chars) for i in range(rnd.randint(a, b)))
+    for i in range(n):
+        user = rstr(USERCHARS, 3, 12)
+        pwd = rstr(PWDCHARS, 6, 14)
+        email = '%s@%s' % (user, rnd.choice(DOMAINS)) if rnd.random() < .6 else ''
+        md5 = ''
+        if rnd.random() < .4:
+            md5 = hashlib.md5(pwd.encode('ascii')).hexdigest()
+            pwd = ''
+        yield ('%s\t%s\t%s\t%s\n' % (user, email, pwd, md5)).encode('utf-8')
+
+
+def gen_csv(n, seed=0, cols=40):
+    '''A wide CSV file with a header and mixed column types.'''
+    rnd = random.Random(seed)
+    kinds = [rnd.choice('ifts') for i in range(cols)]
+    yield ','.join(['id'] + ['c%d' % i for i in range(cols)]) + '\r\n'
+    for i in range(n):
+        row = [str(i)]
+        for kind in kinds:
+            if rnd.random() < .05:
+                row.append(rnd.choice(('', 'NULL', 'N/A')))
+            elif kind == 'i':
+                row.append(str(rnd.randint(-10 ** 6, 10 ** 6)))
+            elif kind == 'f':
+                row.append('%.4f' % rnd.uniform(-1000, 1000))
+            elif kind == 't':
+                row.append('"%s, %s"' % (rnd.choice(MODERN), rnd.choice(CLASSICAL)))
+            else:
+                row.append(''.join(rnd.choice(USERCHARS) for j in range(8)))
+        yield ','.join(row) + '\r\n'
+
+
+def gen_phrases(n, seed=0):
+    '''A phrase dictionary of concatenated token runs.'''
+    rnd = random.Random(seed)
+    phrases = set()
+    for words in gen_zhwords(max(n // 4, 1), seed + 1):
+        for i in range(4):
+            pos = rnd.randrange(len(words))
+            phrases.add(''.join(words[pos:pos + rnd.randint(2, 4)]))
+    for phrase in sorted(phrases):
+        yield phrase + '\n'
+
+
+def gen_wwstar(n, seed=0):
+    '''A WWStar dictionary: pairs of word and translation lines in GBK.'''
+    rnd = random.Random(seed)
+    for words in gen_zhwords(max(n // 8, 1), seed + 2):
+        for i in range(4):
+            pos = rnd.randrange(len(words))
+            word = ''.join(words[pos:pos + rnd.randint(1, 3)])[:9]
+            trans = ''.join(rnd.choice(MODERN) for j in range(rnd.randint(1, 3)))
+            yield (word + '\r\n' + trans + '\r\n').encode('gbk', 'replace')
+
+
+def makewwstar(path, dictfile):
+    '''Make a WWStar directory at `path` from a `gen_wwstar` file.'''
+    datadir = os.path.join(path, 'Script')
+    os.makedirs(datadir, exist_ok=True)
+    with open(os.path.join(datadir, 'VERSION.DAT'), 'wb') as f:
+        f.write(b'WWStar\r\n2.0\r\n\r\n\r\nWWS\r\n')
+    files = {}
+    with open(dictfile, 'rb') as f:
+        lines = f.read().splitlines(True)
+    for word, trans in zip(lines[::2], lines[1::2]):
+        length = len(word.decode('gbk').strip())
+        if length not in files:
+            files[length] = open(os.path.join(datadir, 'WWS.%d' % length), 'wb')
+        files[length].write(word + trans)
+    for f in files.values():
+        f.close()
+
+
+def gen_pdb(n, seed=0, filename=None):
+    '''A Haodoo PDB book with about `n` lines of text in 100-line chapters.'''
+    from haodoo.pdbreader import PdbFile
+    pf = PdbFile()
+    pf.title = '合成書'
+    pf.author = '無名氏'
+    lines = list(gen_zhtext(n, seed))
+    pf.text = [''.join(lines[i:i + 100]) for i in range(0, len(lines), 100)]
+    pf.contents = ['第%d章' % (i + 1) for i in range(len(pf.text))]
+    pf.dump(filename)
+
+
+GENERATORS = collections.OrderedDict((
+    ('zhtext', gen_zhtext),
+    ('tokens', gen_tokens),
+    ('dump', gen_dump),
+    ('records', gen_records),
+    ('csv', gen_csv),
+    ('phrases', gen_phrases),
+    ('wwstar', gen_wwstar),
+    ('pdb', gen_pdb),
+))
+
+
+class Dataset:
+    '''Generated data of one kind, as a file and (lazily) as lines.'''
+
+    def __init__(self, kind, lines, tmpdir):
+        self.kind = kind
+        self.path = os.path.join(tmpdir, '%s.%d' % (kind, lines))
+        if kind == 'pdb':
+            gen_pdb(lines, filename=self.path)
+        else:
+            with open(self.path, 'wb') as f:
+                for ln in GENERATORS[kind](lines):
+                    f.write(ln if isinstance(ln, bytes) else ln.encode('utf-8'))
+        if kind == 'wwstar':
+            makewwstar(self.path + '.dir', self.path)
+        self.size = os.path.getsize(self.path)
+        self._lines = None
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            with open(self.path, 'rb') as f:
+                self._lines = f.read().splitlines(True)
+            if self.kind not in ('dump', 'records', 'wwstar'):
+                self._lines = [ln.decode('utf-8') for ln in self._lines]
+        return self._lines
+
+    @property
+    def count(self):
+        if self.kind == 'pdb':
+            return None
+        return len(self.lines)
+
+### Benchmarks
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name, kind, uses=()):
+    '''
+    Register a function benchmark over the `kind` dataset, which also needs
+    the `uses` datasets. The decorated function takes the datasets and
+    returns the callable to time.
+    '''
+    def wrapper(fn):
+        BENCHMARKS[name] = (kind, None, fn, tuple(uses))
+        return fn
+    return wrapper
+
+
+def script(name, kind, cmdline):
+    '''
+    Register a script benchmark. `cmdline` is the command line; '{input}' and
+    the dataset kinds in braces are replaced by the dataset paths, and the
+    `kind` dataset is fed to stdin.
+    '''
+    uses = [k for k in GENERATORS if '{%s}' % k in ' '.join(cmdline)]
+    BENCHMARKS[name] = (kind, cmdline, None, tuple(uses))
+
+
+@benchmark('zhutil.calctxtstat', 'zhtext')
+def _(data):
+    import zhutil
+    zhutil.loadzhmodel()
+    lines = data['zhtext'].lines
+    return lambda: [zhutil.calctxtstat(ln) for ln in lines]
+
+
+@benchmark('zhutil.calctxtstat_batch', 'zhtext')
+def _(data):
+    import zhutil
+    zhutil.calctxtstat_batch([''])
+    lines = data['zhtext'].lines
+    return lambda: zhutil.checktxttype_batch(zhutil.calctxtstat_batch(lines))
+
+
+@benchmark('zhutil.splitsentence', 'zhtext')
+def _(data):
+    import zhutil
+    lines = data['zhtext'].lines
+    return lambda: [zhutil.splitsentence(ln) for ln in lines]
+
+
+@benchmark('zhutil.splitstream', 'zhtext')
+def _(data):
+    import zhutil
+    text = ''.join(data['zhtext'].lines)
+    chunks = [text[i:i + 65536] for i in range(0, len(text), 65536)]
+    return lambda: list(zhutil.splitstream(chunks))
+
+
+@benchmark('zhutil.filterlist', 'zhtext')
+def _(data):
+    import zhutil
+    lines = data['zhtext'].lines
+    return lambda: [list(zhutil.filterlist(zhutil.fixmissing(
+        zhutil.splitsentence(ln)))) for ln in lines]
+
+
+@benchmark('zhutil.filterspans', 'zhtext')
+def _(data):
+    import zhutil
+    lines = data['zhtext'].lines
+    return lambda: [zhutil.slicespans(ln, zhutil.filterspans(
+        ln, zhutil.fixmissingspans(ln, zhutil.splitspans(ln))))
+        for ln in lines]
+
+
+@benchmark('zhutil.fw2hw', 'zhtext')
+def _(data):
+    import zhutil
+    lines = data['zhtext'].lines
+    return lambda: [zhutil.fw2hw(ln) for ln in lines]
+
+
+@benchmark('zhutil.makenormalizer', 'zhtext')
+def _(data):
+    import zhutil
+    normalize = zhutil.makenormalizer()
+    lines = data['zhtext'].lines
+    return lambda: [normalize(ln) for ln in lines]
+
+
+@benchmark('zhutil.normalize_steps', 'zhtext')
+def _(data):
+    import zhutil
+    import gbk_pua
+    lines = data['zhtext'].lines
+    return lambda: [zhutil.detokenize(gbk_pua.gbk_pua_convert(
+        zhutil.removectrl(zhutil.fw2hw(ln)))) for ln in lines]
+
+
+@benchmark('zhutil.addwallzone', 'tokens')
+def _(data):
+    import zhutil
+    lines = data['tokens'].lines
+    return lambda: [zhutil.addwallzone(ln.split()) for ln in lines]
+
+
+@benchmark('num2chinese.makeconverter', 'zhtext')
+def _(data):
+    import num2chinese
+    lines = data['zhtext'].lines
+    def run():
+        convert = num2chinese.makeconverter()
+        return [convert(ln) for ln in lines]
+    return run
+
+
+@benchmark('phrasecombine.combine', 'tokens', ['phrases'])
+def _(data):
+    import phrasecombine
+    pc = phrasecombine.PhraseCombiner(data['phrases'].path)
+    lines = data['tokens'].lines
+    return lambda: [pc.combine(ln.split()) for ln in lines]
+
+
+def _slicing_translate(d, maxlen, sentence):
+    # WWStarEngine.translate before the shared trie matcher
+    n = len(sentence)
+    pos = 0
+    while pos < n:
+        i = pos
+        frag = sentence[pos]
+        maxword = None
+        maxpos = 0
+        while i < n and i < pos + maxlen:
+            if frag in d:
+                maxword = frag
+                maxpos = i
+            i += 1
+            frag = sentence[pos:i+1]
+        if maxword is None:
+            yield sentence[pos]
+            pos += 1
+        else:
+            yield d[maxword]
+            pos = maxpos + 1
+
+
+def _wwstar(data):
+    path = data['wwstar'].path + '.dir'
+    lines = data['zhtext'].lines
+    # long documents
+    docs = [''.join(lines[i:i+500]) for i in range(0, len(lines), 500)]
+    return path, docs
+
+
+@benchmark('WWStarClone.load', 'wwstar')
+def _(data):
+    import WWStarClone
+    path = data['wwstar'].path + '.dir'
+    WWStarClone.WWStarEngine(path)
+    return lambda: WWStarClone.WWStarEngine(path)
+
+
+@benchmark('WWStarClone.load_nocache', 'wwstar')
+def _(data):
+    import WWStarClone
+    path = data['wwstar'].path + '.dir'
+    return lambda: WWStarClone.WWStarEngine(path, False)
+
+
+@benchmark('WWStarClone.translate', 'zhtext', ['wwstar'])
+def _(data):
+    import WWStarClone
+    path, docs = _wwstar(data)
+    te = WWStarClone.WWStarEngine(path)
+    return lambda: list(te.translate_many(docs))
+
+
+@benchmark('WWStarClone.translate_slicing', 'zhtext', ['wwstar'])
+def _(data):
+    import WWStarClone
+    path, docs = _wwstar(data)
+    te = WWStarClone.WWStarEngine(path, False)
+    return lambda: [''.join(_slicing_translate(te.d, te.maxlen, doc))
+                    for doc in docs]
+
+
+@benchmark('simpdump.process_line', 'dump')
+def _(data):
+    import simpdump
+    lines = data['dump'].lines
+    return lambda: [simpdump.process_line(ln) for ln in lines]
+
+
+def _dump2db(data, *bulk, jobs=1):
+    import dump2db
+    path = data['records'].path
+    dbfile = os.path.join(os.path.dirname(path), 'leaks.db')
+
+    def run():
+        if os.path.exists(dbfile):
+            os.unlink(dbfile)
+        dump2db.opendb(dbfile, not bulk)
+        table = 'records'
+        if bulk:
+            dump2db.setpragmas(*bulk[1:])
+            table = dump2db.bulk_begin(bulk[0])
+        dump2db.import_records(dump2db.fileblocks(path, 0, dump2db.BLOCK),
+                               dump2db.Metrics(jobs), table, jobs, filename=path)
+        dump2db.finish_import()
+        dump2db.db.close()
+    return run
+
+
+benchmark('dump2db.import', 'records')(lambda data: _dump2db(data))
+benchmark('dump2db.import_bulk', 'records')(lambda data: _dump2db(data, False))
+benchmark('dump2db.import_bulk_fast', 'records')(lambda data: _dump2db(data, False, True))
+benchmark('dump2db.import_bulk_sorted', 'records')(lambda data: _dump2db(data, True, True))
+benchmark('dump2db.import_parallel', 'records')(
+    lambda data: _dump2db(data, False, True, jobs=os.cpu_count()))
+
+
+def _digests(data):
+    return [hashlib.md5(ln).digest() for ln in data['records'].lines]
+
+
+@benchmark('md5set.build', 'records')
+def _(data):
+    from md5set import MD5Set
+    digests = _digests(data)
+    return lambda: MD5Set.build(digests)
+
+
+@benchmark('md5set.build_set', 'records')
+def _(data):
+    digests = _digests(data)
+    return lambda: set(bytes(d) for d in digests)
+
+
+@benchmark('md5set.contains', 'records')
+def _(data):
+    from md5set import MD5Set
+    digests = _digests(data)
+    md5s = MD5Set.build(digests[::2])
+    return lambda: [d in md5s for d in digests]
+
+
+@benchmark('md5set.contains_many', 'records')
+def _(data):
+    from md5set import MD5Set
+    digests = _digests(data)
+    md5s = MD5Set.build(digests[::2])
+    return lambda: md5s.contains_many(digests)
+
+
+@benchmark('pdbreader.load', 'pdb')
+def _(data):
+    from haodoo.pdbreader import PdbFile
+    path = data['pdb'].path
+    return lambda: PdbFile(path)
+
+
+script('script.textnorm', 'zhtext', ['textnorm.py'])
+script('script.mosesprep', 'tokens', ['mosesprep.py', '-z'])
+script('script.num2chinese', 'zhtext', ['num2chinese.py'])
+script('script.csvsql', 'csv', ['csvsql.py', '-i', '{input}'])
+script('script.phrasecombine', 'tokens', ['phrasecombine.py', '{phrases}'])
+script('script.WWStarClone', 'zhtext', ['WWStarClone.py', '{wwstar}.dir'])
+script('script.simpdump', 'dump', ['simpdump.py', '-1'])
+script('script.simpdump.parallel', 'dump', ['simpdump.py', '-j', '0'])
+script('script.simpdump.file', 'dump', ['simpdump.py', '-j', '0', '{input}'])
+script('script.splitrecutfilter', 'zhtext', ['splitrecutfilter.py', 'noop'])
+script('script.splitrecutfilter.parallel', 'zhtext',
+       ['splitrecutfilter.py', '-j', '0', 'noop'])
+
+### Runner
+
+# ru_maxrss survives exec, so a child forked from this (large) process would
+# report our own peak. /proc/self/status VmHWM is reset by exec instead.
+_RSS_HOOK = r'''
+import sys, atexit, runpy
+def _hwm(fn=sys.argv[1]):
+    try:
+        with open('/proc/self/status') as f, open(fn, 'w') as w:
+            w.write(''.join(l.split()[1] for l in f if l.startswith('VmHWM')))
+    except OSError:
+        pass
+atexit.register(_hwm)
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def kinds_needed(names):
+    kinds = set()
+    for name in names:
+        kind, cmdline, fn, uses = BENCHMARKS[name]
+        kinds.add(kind)
+        kinds.update(uses)
+    return kinds
+
+
+def run_function(fn, data, repeat):
+    func = fn(data)
+    best = None
+    for i in range(repeat):
+        t = time.perf_counter()
+        func()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak // 1024
+
+
+def run_script(cmdline, data, kind, repeat):
+    paths = {k: v.path for k, v in data.items()}
+    paths['input'] = data[kind].path
+    hwmfile = os.path.join(os.path.dirname(paths['input']), 'hwm')
+    cmd = [sys.executable, '-c', _RSS_HOOK, hwmfile,
+           os.path.join(_curpath, cmdline[0])]
+    cmd.extend(arg.format(**paths) for arg in cmdline[1:])
+    best = peak = None
+    for i in range(repeat):
+        with open(data[kind].path, 'rb') as stdin, \
+             tempfile.TemporaryFile() as stderr:
+            t = time.perf_counter()
+            proc = subprocess.Popen(
+                cmd, stdin=stdin, stdout=subprocess.DEVNULL, stderr=stderr,
+                cwd=_curpath)
+            status, rusage = os.wait4(proc.pid, 0)[1:]
+            t = time.perf_counter() - t
+            if status:
+                stderr.seek(0)
+                lines = stderr.read().decode('utf-8', 'replace').splitlines()
+                raise RuntimeError(lines[-1] if lines else 'exit status %d' % status)
+        best = t if best is None else min(best, t)
+        try:
+            with open(hwmfile) as f:
+                maxrss = int(f.read())
+            os.unlink(hwmfile)
+        except (OSError, ValueError):
+            maxrss = rusage.ru_maxrss
+        peak = max(peak or 0, maxrss)
+    return best, peak
+
+
+def run(names, scale=1., repeat=3):
+    lines = max(int(20000 * scale), 100)
+    results = collections.OrderedDict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # don't leave compiled dictionaries of temporary data behind
+        os.environ['NLPUTILS_CACHE'] = os.path.join(tmpdir, 'cache')
+        data = {kind: Dataset(kind, lines, tmpdir)
+                for kind in kinds_needed(names)}
+        for name in names:
+            kind, cmdline, fn, uses = BENCHMARKS[name]
+            ds = data[kind]
+            print(name, end=' ', file=sys.stderr, flush=True)
+            try:
+                if cmdline:
+                    seconds, peak = run_script(cmdline, data, kind, repeat)
+                else:
+                    seconds, peak = run_function(fn, data, repeat)
+            except Exception as ex:
+                results[name] = {'error': '%s: %s' % (type(ex).__name__, ex)}
+                print('failed', file=sys.stderr)
+                continue
+            results[name] = collections.OrderedDict((
+                ('seconds', seconds),
+                ('bytes', ds.size),
+                ('lines', ds.count),
+                ('mb_per_s', ds.size / seconds / 1e6),
+                ('lines_per_s', ds.count / seconds if ds.count else None),
+                ('peak_kb', peak),
+            ))
+            print('%.3fs' % seconds, file=sys.stderr)
+    return results
+
+
+def report(results, baseline=None, tolerance=.1):
+    '''Print results, compared to `baseline`. Return number of regressions.'''
+    regressions = 0
+    print('%-32s %12s %9s %10s %9s' % (
+        'benchmark', 'lines/s', 'MB/s', 'peak KiB', 'speedup'))
+    for name, r in results.items():
+        if 'error' in r:
+            print('%-32s %s' % (name, r['error']))
+            continue
+        speedup = ''
+        base = baseline and baseline.get(name)
+        if base and 'seconds' in base:
+            ratio = base['seconds'] / r['seconds']
+            speedup = '%.2fx' % ratio
+            if ratio < 1 / (1 + tolerance):
+                speedup += ' !'
+                regressions += 1
+        print('%-32s %12s %9.2f %10d %9s' % (
+            name, '%.0f' % r['lines_per_s'] if r['lines_per_s'] else '-',
+            r['mb_per_s'], r['peak_kb'], speedup))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run benchmarks.")
+    subparsers = parser.add_subparsers(dest='command')
+    p_run = subparsers.add_parser('run', help="run benchmarks")
+    p_run.add_argument("-s", "--scale", type=float, default=1.,
+        help="data size multiplier, 1 is 20000 lines (default: 1)")
+    p_run.add_argument("-r", "--repeat", type=int, default=3,
+        help="timing runs, the best one is reported (default: 3)")
+    p_run.add_argument("-o", "--output", default='bench_results.json',
+        help="save results to this JSON file (default: bench_results.json)")
+    p_run.add_argument("-b", "--baseline",
+        help="compare with results saved in this JSON file")
+    p_run.add_argument("-t", "--tolerance", type=float, default=.1,
+        help="slowdown that counts as a regression (default: 0.1)")
+    p_run.add_argument("name", nargs='*', help="benchmark name prefixes")
+    p_gen = subparsers.add_parser('gen', help="write synthetic data to stdout")
+    p_gen.add_argument("-n", "--lines", type=int, default=20000,
+        help="number of lines (default: 20000)")
+    p_gen.add_argument("kind", choices=tuple(GENERATORS))
+    subparsers.add_parser('list', help="list benchmarks")
+    args = parser.parse_args()
+    if args.command == 'gen':
+        if args.kind == 'pdb':
+            if sys.stdout.isatty():
+                parser.error('redirect the PDB output to a file')
+            with tempfile.TemporaryDirectory() as tmpdir:
+                filename = os.path.join(tmpdir, 'book.pdb')
+                gen_pdb(args.lines, filename=filename)
+                with open(filename, 'rb') as f:
+                    sys.stdout.buffer.write(f.read())
+        else:
+            for ln in GENERATORS[args.kind](args.lines):
+                sys.stdout.buffer.write(
+                    ln if isinstance(ln, bytes) else ln.encode('utf-8'))
+        return 0
+    elif args.command == 'list':
+        for name, (kind, cmdline, fn, uses) in BENCHMARKS.items():
+            print('%-32s %s' % (name, kind))
+        return 0
+    elif args.command != 'run':
+        parser.print_help()
+        return 1
+    names = [name for name in BENCHMARKS if not args.name or
+             any(name.startswith(prefix) for prefix in args.name)]
+    results = run(names, args.scale, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    regressions = report(results, baseline, args.tolerance)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'scale': args.scale,
+            },
+            'results': results
+        }, f, indent=1)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
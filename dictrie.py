@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import array
+import struct
+import bisect
+import collections
+from fileutil import atomicwrite
+
+'''
+Compact array-backed trie for dictionary lookups, and a greedy longest
+match engine over it.
+
+Nodes are numbered in breadth-first order, so the children of a node are
+a contiguous, sorted range of node numbers:
+
+    labels[n]       code point of the edge into node n (0 for the root)
+    first[n]        first child of node n; its children are
+                    first[n] .. first[n+1]-1
+    terminal[n]     1 if the path to node n is a word
+    vindex[n]       index of the value of the word in `values`, or -1
+                    (only for dictionaries with values)
+
+That is 9 bytes per node, instead of a dict entry and a str per prefix.
+The compiled form is the same arrays after a header, and is memory-mapped
+when loaded:
+
+    python3 dictrie.py dict.txt dict.trie
+'''
+
+
+TRIE_MAGIC = b'NLPTRIE\0'
+# magic, nodes, values, max word length
+TRIE_HEADER = struct.Struct('<8sIII')
+
+
+class StringTable:
+    '''Read-only sequence of strings stored as UTF-8 in one buffer.'''
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return str(self.blob[self.offsets[index]:self.offsets[index+1]], 'utf-8')
+
+
+class Trie:
+    def __init__(self, labels, first, terminal, maxlen, values=None, vindex=None):
+        self.labels = labels
+        self.first = first
+        self.terminal = terminal
+        # length of the longest word
+        self.maxlen = maxlen
+        self.values = values
+        self.vindex = vindex
+        # children of the root, looked up at every position
+        self._root = None
+
+    @classmethod
+    def build(cls, words):
+        '''
+        Build a trie from an iterable of words, or from a dict of words to
+        string values.
+        '''
+        if isinstance(words, dict):
+            mapping = words
+            words = sorted(mapping)
+            values = []
+            vindex = array.array('i')
+        else:
+            words = sorted(set(words))
+            values = vindex = None
+        labels = array.array('I', (0,))
+        first = array.array('I')
+        terminal = bytearray()
+        maxlen = 0
+        queue = collections.deque(((0, len(words), 0),))
+        while queue:
+            lo, hi, depth = queue.popleft()
+            maxlen = depth
+            if lo < hi and len(words[lo]) == depth:
+                terminal.append(1)
+                if values is not None:
+                    vindex.append(len(values))
+                    values.append(mapping[words[lo]])
+                lo += 1
+            else:
+                terminal.append(0)
+                if values is not None:
+                    vindex.append(-1)
+            first.append(len(labels))
+            while lo < hi:
+                ch = words[lo][depth]
+                end = lo + 1
+                while end < hi and words[end][depth] == ch:
+                    end += 1
+                labels.append(ord(ch))
+                queue.append((lo, end, depth + 1))
+                lo = end
+        first.append(len(labels))
+        return cls(labels, first, terminal, maxlen, values, vindex)
+
+    @classmethod
+    def fromfile(cls, filename):
+        '''Load a text dictionary (one word per line) or a compiled trie.'''
+        with open(filename, 'rb') as f:
+            magic = f.read(len(TRIE_MAGIC))
+        if magic == TRIE_MAGIC:
+            return cls.load(filename)
+        with open(filename, 'r') as f:
+            return cls.build(ln.strip() for ln in f)
+
+    @classmethod
+    def load(cls, filename):
+        '''Memory-map a compiled trie.'''
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(mm) < TRIE_HEADER.size:
+            raise ValueError('not a compiled trie: %s' % filename)
+        magic, nodes, nvalues, maxlen = TRIE_HEADER.unpack_from(mm)
+        if magic != TRIE_MAGIC:
+            raise ValueError('not a compiled trie: %s' % filename)
+        if sys.byteorder != 'little':
+            raise NotImplementedError('compiled tries are little endian')
+        pos = TRIE_HEADER.size
+        # header, labels, first, padded terminal, vindex and value offsets
+        size = pos + nodes * 8 + 4 + -(-nodes // 4) * 4
+        if nvalues:
+            size += nodes * 4 + (nvalues + 1) * 4
+        if len(mm) < size:
+            raise ValueError('truncated trie: %s' % filename)
+        mv = memoryview(mm)
+        labels = mv[pos:pos + nodes * 4].cast('I')
+        pos += nodes * 4
+        first = mv[pos:pos + (nodes + 1) * 4].cast('I')
+        pos += (nodes + 1) * 4
+        terminal = mv[pos:pos + nodes]
+        # padded for alignment
+        pos += -(-nodes // 4) * 4
+        values = vindex = None
+        if nvalues:
+            vindex = mv[pos:pos + nodes * 4].cast('i')
+            pos += nodes * 4
+            offsets = mv[pos:pos + (nvalues + 1) * 4].cast('I')
+            pos += (nvalues + 1) * 4
+            if len(mv) - pos < offsets[-1]:
+                raise ValueError('truncated trie: %s' % filename)
+            values = StringTable(offsets, mv[pos:])
+        return cls(labels, first, terminal, maxlen, values, vindex)
+
+    def save(self, filename):
+        '''Write the compiled trie to `filename` atomically.'''
+        if sys.byteorder != 'little':
+            raise NotImplementedError('compiled tries are little endian')
+        nodes = len(self.labels)
+        nvalues = len(self.values) if self.values else 0
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        with atomicwrite(filename) as f:
+            f.write(TRIE_HEADER.pack(TRIE_MAGIC, nodes, nvalues, self.maxlen))
+            f.write(bytes(self.labels))
+            f.write(bytes(self.first))
+            f.write(bytes(self.terminal))
+            f.write(bytes(-nodes % 4))
+            if nvalues:
+                f.write(bytes(self.vindex))
+                blobs = [v.encode('utf-8') for v in self.values]
+                offsets = array.array('I', (0,))
+                for b in blobs:
+                    offsets.append(offsets[-1] + len(b))
+                f.write(bytes(offsets))
+                f.write(b''.join(blobs))
+
+    def __len__(self):
+        return sum(self.terminal)
+
+    def __contains__(self, word):
+        node = self.walk(0, word)
+        return node >= 0 and self.terminal[node] == 1
+
+    def get(self, word, default=None):
+        node = self.walk(0, word)
+        if node < 0 or not self.terminal[node]:
+            return default
+        return self.value(node)
+
+    def value(self, node):
+        '''The value of the word at `node`, or None.'''
+        if self.vindex is None or self.vindex[node] < 0:
+            return None
+        return self.values[self.vindex[node]]
+
+    def items(self):
+        '''Yields (word, value) for all words, in sorted order.'''
+        stack = [(0, '')]
+        while stack:
+            node, word = stack.pop()
+            if self.terminal[node]:
+                yield word, self.value(node)
+            for child in range(self.first[node + 1] - 1, self.first[node] - 1, -1):
+                stack.append((child, word + chr(self.labels[child])))
+
+    def child(self, node, ch):
+        '''The child of `node` along `ch`, or -1.'''
+        lo = self.first[node]
+        hi = self.first[node + 1]
+        code = ord(ch)
+        i = bisect.bisect_left(self.labels, code, lo, hi)
+        if i < hi and self.labels[i] == code:
+            return i
+        return -1
+
+    def walk(self, node, s):
+        '''Follow the string `s` from `node`. Returns the node or -1.'''
+        labels = self.labels
+        first = self.first
+        bisect_left = bisect.bisect_left
+        if node < 0:
+            return node
+        for ch in s:
+            lo = first[node]
+            hi = first[node + 1]
+            code = ord(ch)
+            node = bisect_left(labels, code, lo, hi)
+            if node >= hi or labels[node] != code:
+                return -1
+        return node
+
+    def isprefix(self, node):
+        '''Whether the path to `node` is a word or a prefix of one.'''
+        return node > 0 or (node == 0 and self.terminal[0] == 1)
+
+    def matchchars(self, s, pos):
+        '''
+        The longest word at the start of `s[pos:]`, as (end, node), or
+        (pos, -1). Words are at least one character long.
+        '''
+        labels = self.labels
+        first = self.first
+        terminal = self.terminal
+        bisect_left = bisect.bisect_left
+        node = 0
+        end = pos
+        match = -1
+        for code in map(ord, s[pos:pos + self.maxlen]):
+            lo = first[node]
+            hi = first[node + 1]
+            if hi - lo == 1:
+                # most nodes deep in the trie have only one child
+                if labels[lo] != code:
+                    break
+                node = lo
+            else:
+                node = bisect_left(labels, code, lo, hi)
+                if node >= hi or labels[node] != code:
+                    break
+            pos += 1
+            if terminal[node]:
+                end = pos
+                match = node
+        return end, match
+
+    def matchtokens(self, tokens, pos, sep=''):
+        '''
+        The longest `sep.join(tokens[pos:end])` that is a word, as
+        (end, node), or (pos, -1). Stops at the first token that leaves
+        the trie.
+        '''
+        labels = self.labels
+        first = self.first
+        terminal = self.terminal
+        bisect_left = bisect.bisect_left
+        n = len(tokens)
+        node = 0
+        end = pos
+        match = -1
+        s = tokens[pos]
+        while 1:
+            for code in map(ord, s):
+                lo = first[node]
+                hi = first[node + 1]
+                if hi - lo == 1:
+                    if labels[lo] != code:
+                        return end, match
+                    node = lo
+                    continue
+                node = bisect_left(labels, code, lo, hi)
+                if node >= hi or labels[node] != code:
+                    return end, match
+            pos += 1
+            if terminal[node]:
+                end = pos
+                match = node
+            elif not node:
+                # only empty strings so far, and '' is not a word
+                return end, match
+            if pos >= n:
+                return end, match
+            s = sep + tokens[pos]
+
+    def segment(self, seq, sep=''):
+        '''
+        Greedy longest match segmentation of a string (by characters) or a
+        sequence of tokens joined by `sep`. Returns a list of
+        (start, end, node) for each segment; node is -1 for an unmatched
+        character or token.
+        '''
+        if isinstance(seq, str):
+            return self._segmentchars(seq)
+        res = []
+        n = len(seq)
+        pos = 0
+        match = self.matchtokens
+        while pos < n:
+            end, node = match(seq, pos, sep)
+            if node < 0:
+                end = pos + 1
+            res.append((pos, end, node))
+            pos = end
+        return res
+
+    def _segmentchars(self, s):
+        # matchchars inlined, this is the hot loop for long documents
+        labels = self.labels
+        first = self.first
+        terminal = self.terminal
+        bisect_left = bisect.bisect_left
+        if self._root is None:
+            self._root = {labels[i]: i for i in range(first[0], first[1])}
+        rootget = self._root.get
+        codes = memoryview(s.encode('utf-32-le', 'surrogatepass')).cast('I')
+        n = len(codes)
+        res = []
+        pos = 0
+        while pos < n:
+            node = rootget(codes[pos])
+            if node is None:
+                res.append((pos, pos + 1, -1))
+                pos += 1
+                continue
+            i = pos + 1
+            if terminal[node]:
+                end = i
+                match = node
+            else:
+                end = pos + 1
+                match = -1
+            while i < n:
+                lo = first[node]
+                hi = first[node + 1]
+                if lo == hi:
+                    break
+                code = codes[i]
+                if hi - lo == 1:
+                    # most nodes deep in the trie have only one child
+                    if labels[lo] != code:
+                        break
+                    node = lo
+                else:
+                    node = bisect_left(labels, code, lo, hi)
+                    if node >= hi or labels[node] != code:
+                        break
+                i += 1
+                if terminal[node]:
+                    end = i
+                    match = node
+            res.append((pos, end, match))
+            pos = end
+        return res
+
+    def segmentmany(self, seqs, sep=''):
+        '''Segment each of `seqs`. Yields (seq, segments) for each.'''
+        segment = self.segment
+        for seq in seqs:
+            yield seq, segment(seq, sep)
+
+
+if __name__ == '__main__':
+    Trie.fromfile(sys.argv[1]).save(sys.argv[2])
@@ -1,65 +1,515 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import io
 import os
 import sys
+import mmap
+import time
 import sqlite3
+import argparse
 import hashlib
 import binascii
+import tempfile
+import itertools
+import multiprocessing
+from fileutil import lineranges, progress, imap_bounded
+from md5set import MD5Set, md5digest
 
-db = sqlite3.connect('leaks.db')
-cur = db.cursor()
+'''
+Make a database from the output of simpdump.py.
 
-cur.execute('CREATE TABLE IF NOT EXISTS records ('
-    'username TEXT,'
-    'email TEXT,'
-    'password TEXT,'
-    'md5 BLOB'
-')')
-cur.execute('CREATE INDEX IF NOT EXISTS md5_index ON records (md5)')
+    dump2db.py [-D leaks.db] [-j JOBS] [-r REJECTS] [-B [-F] [-S]] [-p|-v|-d] [file]
 
-def update_records(stream, debug=False):
-    for ln in stream:
+Records are read from `file`, or stdin, parsed in blocks by -j processes
+and inserted in batches by this process, the only writer. Lines that can't
+be parsed go to the -r file. With a file, the input offset is saved in the
+`checkpoint` table in the same transaction as the records, so an
+interrupted import resumes where it was committed. Time spent in each
+stage is reported on stderr.
+
+Every record has a 16-byte hash of its fields with a unique index, so
+duplicate records are ignored when inserted. -v migrates databases made
+before that: it adds the hashes and deletes the duplicates once, keeping
+the first.
+
+In bulk mode (-B), the indexes are dropped during the import. At the
+end, or when interrupted, duplicates are deleted and the indexes are
+rebuilt once; any other run also rebuilds them if they are missing. -S
+also stages the records and inserts them ordered by md5, so the table
+and the index are written sequentially. -F keeps the rollback
+journal in memory and doesn't sync: much faster, but a system crash can
+corrupt the database.
+'''
+
+db = cur = None
+# lines per insert batch from a stream, and bytes per block of a file
+BATCH = 10000
+BLOCK = 1 << 20
+
+def rowhash(*fields):
+    '''Hash of the fields of a record. Text and blobs differ, as in SQLite.'''
+    h = hashlib.blake2b(digest_size=16)
+    for f in fields:
+        if f is None:
+            h.update(b'N')
+            continue
+        elif isinstance(f, str):
+            tag = b'T'
+            f = f.encode('utf-8', 'surrogatepass')
+        elif isinstance(f, bytes):
+            tag = b'B'
+        else:
+            tag = b'R'
+            f = repr(f).encode('ascii')
+        h.update(b'%s%d:' % (tag, len(f)))
+        h.update(f)
+    return h.digest()
+
+def opendb(filename, index=True):
+    global db, cur
+    db = sqlite3.connect(filename)
+    db.create_function('rowhash', 4, rowhash, deterministic=True)
+    cur = db.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS records ('
+        'username TEXT,'
+        'email TEXT,'
+        'password TEXT,'
+        'md5 BLOB,'
+        'hash BLOB'
+    ')')
+    cur.execute('CREATE TABLE IF NOT EXISTS checkpoint ('
+        'input TEXT PRIMARY KEY,'
+        'size INTEGER,'
+        'mtime_ns INTEGER,'
+        'offset INTEGER'
+    ')')
+    if index:
+        finish_import()
+
+def migrated():
+    '''Whether the records have hashes.'''
+    return any(row[1] == 'hash' for row in cur.execute('PRAGMA table_info(records)'))
+
+def hasindex(name):
+    return cur.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?",
+                       (name,)).fetchone() is not None
+
+def parse_record(ln):
+    fields = ln.rstrip(b'\n').decode('utf-8', errors='ignore').split('\t')
+    if not any(fields):
+        return None
+    username = fields[0].strip()
+    email = fields[1].strip()
+    password = fields[2]
+    md5 = binascii.a2b_hex(fields[3])
+    return (username, email, password, md5, rowhash(username, email, password, md5))
+
+def parse_records(lines):
+    '''Returns (rows, rejected lines as (line, exception)).'''
+    rows = []
+    rejects = []
+    for ln in lines:
         try:
-            fields = ln.rstrip(b'\n').decode('utf-8', errors='ignore').split('\t')
-            if not any(fields):
-                continue
-            username = fields[0].strip()
-            email = fields[1].strip()
-            password = fields[2]
-            md5 = binascii.a2b_hex(fields[3])
-            if not debug:
-                cur.execute('INSERT INTO records VALUES (?,?,?,?)',
-                            (username, email, password, md5))
+            row = parse_record(ln)
+            if row:
+                rows.append(row)
         except Exception as ex:
-            print(repr(ex), repr(ln))
-
-def update_md5(stream):
-    md5s = set()
-    for row in cur.execute('SELECT DISTINCT md5 FROM records WHERE md5 IS NOT NULL'):
-        md5s.add(row[0])
-    for ln in stream:
-        ln = ln.rstrip(b'\n')
-        md5 = hashlib.md5(ln).digest()
-        if md5 in md5s:
-            cur.execute('UPDATE records SET password=?, md5=? WHERE md5=?',
-                        (ln, b'', md5))
-
-def vacuum():
-    cur.execute('DELETE FROM records WHERE rowid NOT IN (SELECT MIN(RowId) FROM records GROUP BY username, email, password, md5)')
-    cur.execute('VACUUM')
+            rejects.append((ln, ex))
+    return rows, rejects
 
-try:
-    if len(sys.argv) > 1:
-        if sys.argv[1] == '-p':
-            update_md5(sys.stdin.buffer)
-        elif sys.argv[1] == '-v':
-            vacuum()
-        elif sys.argv[1] == '-d':
-            update_records(sys.stdin.buffer, debug=True)
-        else:
-            print('unrecognized arguments')
+def readblock(block):
+    '''
+    The lines of a block: a list of lines, or (filename, start, end) for a
+    byte range of a file. Returns (lines, end offset or None).
+    '''
+    if not isinstance(block, tuple):
+        return block, None
+    filename, start, end = block
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        return io.BytesIO(f.read(end - start)).readlines(), end
+
+def parse_block(block):
+    '''Parse a block. Returns (rows, rejects, lines, end, CPU seconds).'''
+    t = time.process_time()
+    lines, end = readblock(block)
+    rows, rejects = parse_records(lines)
+    return rows, rejects, len(lines), end, time.process_time() - t
+
+def lineblocks(stream, batch):
+    while 1:
+        lines = list(itertools.islice(stream, batch))
+        if not lines:
+            return
+        yield lines
+
+def fileblocks(filename, start, block):
+    '''Split `filename` from `start` into newline-aligned byte ranges.'''
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if start >= size:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        for start, end in lineranges(mm, block, start):
+            yield filename, start, end
+
+def insert_records(rows, table='records'):
+    '''Insert `rows`, except duplicates. Returns the number inserted.'''
+    cur.executemany('INSERT OR IGNORE INTO %s VALUES (?,?,?,?,?)' % table, rows)
+    return cur.rowcount if rows else 0
+
+def getcheckpoint(filename):
+    '''The committed offset of the input file `filename`.'''
+    st = os.stat(filename)
+    row = cur.execute('SELECT size, mtime_ns, offset FROM checkpoint WHERE input=?',
+                      (os.path.abspath(filename),)).fetchone()
+    if row is None:
+        return 0
+    if row[:2] != (st.st_size, st.st_mtime_ns):
+        raise ValueError('%s has changed since it was imported from' % filename)
+    return row[2]
+
+def setcheckpoint(filename, offset):
+    st = os.stat(filename)
+    cur.execute('REPLACE INTO checkpoint VALUES (?,?,?,?)',
+                (os.path.abspath(filename), st.st_size, st.st_mtime_ns, offset))
+
+class Metrics:
+    '''Counters and seconds spent in each stage of an import.'''
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.lines = self.rows = self.duplicates = self.rejects = 0
+        # parse: CPU time in the parsers; wait: writer waiting for them
+        self.parse = self.wait = self.insert = self.commit = 0
+        self.starttime = time.monotonic()
+
+    def __str__(self):
+        seconds = time.monotonic() - self.starttime
+        return ('%d rows, %d duplicates, %d rejected lines in %.1f s, %.0f rows/s; '
+                'parse %.1f s CPU (%.0f lines/s per process, %d processes), '
+                'insert %.1f s, commit %.1f s, waiting for parsers %.1f s' % (
+                self.rows, self.duplicates, self.rejects, seconds,
+                self.rows / max(seconds, 1e-3),
+                self.parse, self.lines / max(self.parse, 1e-3), self.jobs,
+                self.insert, self.commit, self.wait))
+
+def import_records(blocks, metrics, table='records', jobs=1, rejectfile=None,
+                   debug=False, filename=None, commit=1000000, start=0):
+    '''
+    Parse `blocks` in `jobs` processes and insert the rows into `table` in
+    this process, the only writer. Lines that can't be parsed are written
+    to `rejectfile`, or reported on stderr. For byte ranges of `filename`,
+    the records and the checkpoint are committed every `commit` lines.
+    '''
+    pool = None
+    if jobs == 1:
+        results = map(parse_block, blocks)
     else:
-        update_records(sys.stdin.buffer)
-finally:
+        pool = multiprocessing.Pool(jobs)
+        # the writer is usually the bottleneck: don't parse too far ahead
+        results = imap_bounded(pool, parse_block, blocks, jobs * 2)
+    size = os.path.getsize(filename) if filename else 0
+    report = filename and sys.stderr.isatty()
+    lines = 0
+    offset = start
+    try:
+        while 1:
+            t = time.monotonic()
+            try:
+                rows, rejects, nlines, end, cputime = next(results)
+            except StopIteration:
+                break
+            t2 = time.monotonic()
+            metrics.wait += t2 - t
+            metrics.parse += cputime
+            metrics.lines += nlines
+            for ln, ex in rejects:
+                if rejectfile:
+                    rejectfile.write(ln if ln.endswith(b'\n') else ln + b'\n')
+                else:
+                    sys.stderr.write('%r %r\n' % (ex, ln))
+            metrics.rejects += len(rejects)
+            if not debug:
+                count = insert_records(rows, table)
+                metrics.rows += count
+                metrics.duplicates += len(rows) - count
+            t = time.monotonic()
+            metrics.insert += t - t2
+            lines += nlines
+            if end is not None:
+                offset = end
+            if filename and lines >= commit:
+                setcheckpoint(filename, offset)
+                db.commit()
+                if rejectfile:
+                    rejectfile.flush()
+                lines = 0
+                metrics.commit += time.monotonic() - t
+                if report:
+                    progress('dump2db', offset, size, start, metrics.starttime)
+        t = time.monotonic()
+        if filename:
+            setcheckpoint(filename, offset)
+        db.commit()
+        metrics.commit += time.monotonic() - t
+    except BaseException:
+        # records after the checkpoint are imported again on resume
+        db.rollback()
+        raise
+    finally:
+        if pool:
+            pool.terminate()
+    if report and offset > start:
+        progress('dump2db', offset, size, start, metrics.starttime)
+        sys.stderr.write('\n')
+
+def setpragmas(fast=False, cache=256):
+    '''Tune the connection for a bulk import, with a `cache` of MiB.'''
+    cur.execute('PRAGMA cache_size=%d' % -(cache * 1024))
+    cur.execute('PRAGMA temp_store=MEMORY')
+    if fast:
+        cur.execute('PRAGMA journal_mode=MEMORY')
+        cur.execute('PRAGMA synchronous=OFF')
+
+def bulk_begin(sort=False):
+    '''
+    Drop the indexes for a bulk import. Returns the table to insert into:
+    the staging table if the records are to be sorted.
+    '''
+    cur.execute('DROP INDEX IF EXISTS md5_index')
+    cur.execute('DROP INDEX IF EXISTS records_hash')
+    if not sort:
+        return 'records'
+    cur.execute('CREATE TABLE IF NOT EXISTS records_load ('
+        'username TEXT,'
+        'email TEXT,'
+        'password TEXT,'
+        'md5 BLOB,'
+        'hash BLOB'
+    ')')
+    db.commit()
+    return 'records_load'
+
+def dedup():
+    '''
+    Delete duplicate records, keeping the first, and build the unique hash
+    index. Returns the number of records deleted.
+    '''
+    # sorted by the index build, so the duplicates are read in sequence
+    cur.execute('CREATE INDEX IF NOT EXISTS records_hash_sort ON records (hash)')
+    cur.execute('DELETE FROM records WHERE rowid IN (SELECT rowid FROM ('
+        'SELECT rowid, row_number() OVER (PARTITION BY hash ORDER BY rowid) AS n '
+        'FROM records) WHERE n > 1)')
+    count = cur.rowcount
+    cur.execute('CREATE UNIQUE INDEX records_hash ON records (hash)')
+    cur.execute('DROP INDEX records_hash_sort')
+    db.commit()
+    return count
+
+def finish_import():
+    '''
+    Move staged records into `records` by md5, and build the indexes that
+    are missing. Returns the number of duplicates deleted.
+    '''
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name='records_load'").fetchone():
+        cur.execute('INSERT OR IGNORE INTO records SELECT * FROM records_load ORDER BY md5')
+        cur.execute('DROP TABLE records_load')
+        db.commit()
+    count = 0
+    if migrated() and not hasindex('records_hash'):
+        count = dedup()
+    cur.execute('CREATE INDEX IF NOT EXISTS md5_index ON records (md5)')
+    db.commit()
+    return count
+
+# md5s of the records, in each hashing process
+md5s = None
+
+def initworker(filename):
+    '''Load the md5s of the records, compiled to `filename`, in a hashing process.'''
+    global md5s
+    md5s = MD5Set.load(filename)
+
+def hash_block(block):
+    '''
+    Hash the lines of a block. Returns ((word, md5) for words whose md5 is
+    in `md5s`, lines, CPU seconds).
+    '''
+    t = time.process_time()
+    lines, end = readblock(block)
+    words = [ln.rstrip(b'\n') for ln in lines]
+    digests = [md5digest(w) for w in words]
+    hits = [(w, d) for w, d, found in zip(words, digests, md5s.contains_many(digests))
+            if found]
+    return hits, len(lines), time.process_time() - t
+
+def apply_hits(hits):
+    '''Set the passwords of `hits` in one statement. Returns the rows updated.'''
+    cur.executemany('INSERT OR IGNORE INTO hits (password, md5) VALUES (?,?)', hits)
+    # records that become the same as another one replace it
+    cur.execute('UPDATE OR REPLACE records SET '
+        'password=(SELECT password FROM hits WHERE hits.md5=records.md5), '
+        "md5=x'', hash=rowhash(username, email, "
+        "(SELECT password FROM hits WHERE hits.md5=records.md5), x'') "
+        'WHERE md5 IN (SELECT md5 FROM hits)')
+    count = cur.rowcount
+    cur.execute('DELETE FROM hits')
     db.commit()
+    return count
+
+def apply_results(results, batch):
+    '''
+    Apply the hits of `results` of `hash_block`, `batch` at a time. Returns
+    (lines, hits, rows updated, CPU seconds hashing, seconds updating).
+    '''
+    report = sys.stderr.isatty()
+    lines = nhits = updated = 0
+    cputime = updatetime = 0
+    pending = []
+    for hits, nlines, seconds in results:
+        lines += nlines
+        cputime += seconds
+        nhits += len(hits)
+        pending.extend(hits)
+        if len(pending) >= batch:
+            t = time.monotonic()
+            updated += apply_hits(pending)
+            updatetime += time.monotonic() - t
+            pending = []
+            if report:
+                sys.stderr.write('\rdump2db: %d lines hashed, %d hits, %d rows updated ' % (
+                    lines, nhits, updated))
+                sys.stderr.flush()
+    t = time.monotonic()
+    updated += apply_hits(pending)
+    updatetime += time.monotonic() - t
+    if report:
+        sys.stderr.write('\n')
+    return lines, nhits, updated, cputime, updatetime
+
+def update_md5(blocks, jobs=1, batch=100000, tmpdir=None):
+    '''
+    Fill in the password of records whose md5 is of a line of `blocks`.
+    Lines are hashed in `jobs` processes, which memory-map the md5s of the
+    records compiled to a file in `tmpdir`. Hits are applied `batch` at a
+    time with a join through a temporary table.
+    '''
+    global md5s
+    starttime = time.monotonic()
+    digests = (row[0] for row in cur.execute(
+        'SELECT md5 FROM records WHERE length(md5) = 16'))
+    if jobs == 1:
+        md5s = MD5Set.build(digests)
+    else:
+        tmp = tempfile.TemporaryDirectory(dir=tmpdir)
+        filename = os.path.join(tmp.name, 'records.md5set')
+        md5s = MD5Set.build(digests, filename)
+    loadtime = time.monotonic() - starttime
+    cur.execute('CREATE TEMP TABLE IF NOT EXISTS hits ('
+        'md5 BLOB PRIMARY KEY, password TEXT) WITHOUT ROWID')
+    if jobs == 1:
+        stats = apply_results(map(hash_block, blocks), batch)
+    else:
+        with tmp, multiprocessing.Pool(jobs, initworker, (filename,)) as pool:
+            stats = apply_results(imap_bounded(pool, hash_block, blocks, jobs * 2), batch)
+            pool.close()
+            pool.join()
+    lines, nhits, updated, cputime, updatetime = stats
+    seconds = time.monotonic() - starttime
+    sys.stderr.write('dump2db: %d md5s loaded in %.1f s; %d lines hashed in %.1f s, '
+        '%.0f lines/s (%.1f s CPU in %d processes); %d hits, %d rows updated in %.1f s\n' % (
+        len(md5s), loadtime, lines, seconds - loadtime,
+        lines / max(seconds - loadtime, 1e-3), cputime, jobs, nhits, updated, updatetime))
+
+def migrate():
+    '''
+    Add hashes to the records, delete duplicates and vacuum. Only needed
+    once for databases made before the records had hashes.
+    '''
+    if not migrated():
+        cur.execute('ALTER TABLE records ADD COLUMN hash BLOB')
+    cur.execute('UPDATE records SET hash=rowhash(username, email, password, md5) '
+                'WHERE hash IS NULL')
+    db.commit()
+    count = 0
+    if not hasindex('records_hash'):
+        count = dedup()
+    cur.execute('VACUUM')
+    sys.stderr.write('dump2db: %d duplicate records deleted\n' % count)
+
+def main():
+    parser = argparse.ArgumentParser(description="Make a database from leaked password dumps, as output by simpdump.py.")
+    parser.add_argument("-D", "--database", default="leaks.db", help="database file (default: leaks.db)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-p", dest="passwords", action="store_true", help="fill in passwords of md5s from a word list, hashed by -j processes")
+    group.add_argument("-v", dest="vacuum", action="store_true", help="add record hashes to an old database, remove duplicate records and vacuum")
+    group.add_argument("-d", dest="debug", action="store_true", help="only parse the records")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="number of parser processes, 0 for all CPUs (default: 1)")
+    parser.add_argument("-r", "--rejects", help="append lines that can't be parsed to this file (default: report them on stderr)")
+    parser.add_argument("-c", "--commit", type=int, default=1000000, help="lines per transaction and checkpoint when importing a file (default: 1000000)")
+    parser.add_argument("-B", "--bulk", action="store_true", help="bulk import: build md5_index after the import")
+    parser.add_argument("-S", "--sort", action="store_true", help="with -B, insert the records ordered by md5")
+    parser.add_argument("-F", "--fast", action="store_true", help="with -B, no journal and no syncing (unsafe)")
+    parser.add_argument("--cache-size", type=int, default=256, help="with -B, SQLite page cache in MiB (default: 256)")
+    parser.add_argument("file", nargs="?", help="input file (default: stdin)")
+    args = parser.parse_args()
+    if (args.sort or args.fast) and not args.bulk:
+        parser.error('-S and -F need -B')
+    if args.bulk and (args.passwords or args.vacuum):
+        parser.error('-B, -S and -F are only for imports, not with -p or -v')
+    opendb(args.database, not args.bulk)
+    if not (args.vacuum or args.debug or migrated()):
+        parser.error('%s has records without hashes, run dump2db.py -v once to migrate it' % args.database)
+    stream = open(args.file, 'rb') if args.file else sys.stdin.buffer
+    try:
+        if args.passwords:
+            jobs = args.jobs or os.cpu_count()
+            # the md5 set can be as large as the md5 index
+            dbdir = os.path.dirname(os.path.abspath(args.database))
+            if args.file:
+                stream.close()
+                update_md5(fileblocks(args.file, 0, BLOCK), jobs, tmpdir=dbdir)
+            else:
+                update_md5(lineblocks(stream, BATCH), jobs, tmpdir=dbdir)
+        elif args.vacuum:
+            migrate()
+        else:
+            table = 'records'
+            if args.bulk and not args.debug:
+                setpragmas(args.fast, args.cache_size)
+                table = bulk_begin(args.sort)
+            jobs = args.jobs or os.cpu_count()
+            metrics = Metrics(jobs)
+            rejectfile = open(args.rejects, 'ab') if args.rejects else None
+            deleted = 0
+            try:
+                if args.file and not args.debug:
+                    stream.close()
+                    try:
+                        start = getcheckpoint(args.file)
+                    except ValueError as ex:
+                        parser.error(str(ex))
+                    blocks = fileblocks(args.file, start, BLOCK)
+                    import_records(blocks, metrics, table, jobs, rejectfile,
+                                   filename=args.file, commit=max(args.commit, 1), start=start)
+                else:
+                    import_records(lineblocks(stream, BATCH), metrics, table, jobs,
+                                   rejectfile, args.debug)
+            finally:
+                if rejectfile:
+                    rejectfile.close()
+                if not args.debug:
+                    # also rebuilds the indexes dropped by -B if interrupted
+                    deleted = finish_import()
+            # bulk imports insert duplicates and delete them at the end
+            metrics.rows -= deleted
+            metrics.duplicates += deleted
+            sys.stderr.write('dump2db: %s\n' % metrics)
+    finally:
+        db.commit()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import datetime
+import tempfile
+import contextlib
+import collections
+
+'''
+File helpers shared by the scripts: the cache directory, atomic writes,
+newline-aligned byte ranges, a progress line on stderr, and a pool map
+that keeps a bounded number of tasks in flight.
+'''
+
+
+def cachedir():
+    '''Directory for compiled dictionaries.'''
+    path = os.environ.get('NLPUTILS_CACHE')
+    if not path:
+        path = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'), 'nlputils')
+    return path
+
+
+@contextlib.contextmanager
+def atomicwrite(filename, mode='wb'):
+    '''
+    Open a temporary file next to `filename`, which replaces `filename`
+    if the block finishes, and is removed otherwise.
+    '''
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        # the permissions of a new file, not the 0600 of mkstemp
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0o666 & ~umask)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def lineranges(mm, block, start=0):
+    '''Split `mm[start:]` into (start, end) byte ranges of about `block` bytes that end at a newline.'''
+    size = len(mm)
+    while start < size:
+        nl = mm.find(b'\n', start + block - 1)
+        end = size if nl < 0 else nl + 1
+        yield start, end
+        start = end
+
+
+def progress(name, done, size, start, starttime):
+    '''Show `done` of `size` bytes on stderr, counting the rate from `start` at `starttime`.'''
+    rate = (done - start) / max(time.monotonic() - starttime, 1e-3)
+    eta = (size - done) / rate if rate else 0
+    sys.stderr.write('\r%s: %.1f%% (%d/%d MiB), %.1f MiB/s, ETA %s ' % (
+        name, done * 100 / max(size, 1), done >> 20, size >> 20,
+        rate / 1048576, datetime.timedelta(seconds=int(eta))))
+    sys.stderr.flush()
+
+
+def imap_bounded(pool, func, iterable, window):
+    '''
+    Like `pool.imap(func, iterable)`, but with at most `window` tasks
+    submitted and not yet consumed, so neither the input nor the results
+    pile up when the consumer is slower than the workers.
+    '''
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
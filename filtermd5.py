@@ -1,22 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
 import sys
-import hashlib
 import binascii
+import itertools
+from md5set import MD5Set
 
-md5s = set()
+'''
+Drop lines whose md5 (hex, the last ':'-separated field) is known or invalid.
 
-with open(sys.argv[1], 'rb') as f:
-    for ln in f:
-        md5s.add(hashlib.md5(ln.rstrip(b'\n')).digest())
+    filtermd5.py wordlist < hashes > unknown
 
-for ln in sys.stdin.buffer:
-    try:
-        m = binascii.a2b_hex(ln.rstrip(b'\n').split(b':')[-1])
-    except Exception:
-        continue
-    if m not in md5s:
-        sys.stdout.buffer.write(ln)
+`wordlist` is a word list, or a set compiled by md5set.py.
+'''
 
+md5s = MD5Set.fromfile(sys.argv[1])
+
+while 1:
+    lines = list(itertools.islice(sys.stdin.buffer, 65536))
+    if not lines:
+        break
+    keep = []
+    digests = []
+    for ln in lines:
+        try:
+            m = binascii.a2b_hex(ln.rstrip(b'\n').split(b':')[-1])
+        except Exception:
+            continue
+        keep.append(ln)
+        digests.append(m)
+    for ln, found in zip(keep, md5s.contains_many(digests)):
+        if not found:
+            sys.stdout.buffer.write(ln)
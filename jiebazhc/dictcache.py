@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import io
+import mmap
+import array
+import struct
+import hashlib
+import tempfile
+import jieba
+
+'''
+Compiled prefix dictionaries for jieba.
+
+jieba keeps its prefix dictionary cache (`FREQ` and `total`) in a pickle
+named after the dictionary path, in the current or temporary directory.
+Here the cache is keyed by the SHA-1 of the dictionary content and kept in
+a stable cache directory ($NLPUTILS_CACHE, or nlputils in $XDG_CACHE_HOME or
+~/.cache), so it is built once per dictionary, not once per working
+directory.
+
+File format (little endian):
+
+    header: magic 'JBPFDICT', word count (I), key blob size (I), total (Q)
+    keys: UTF-8 words and prefixes, joined by '\n'
+    freqs: word frequencies (Q), 0 for prefixes
+
+Loading it is a read and a split instead of unpickling or parsing the
+dictionary; `FREQ` is still an ordinary dict.
+
+    python3 jiebazhc/dictcache.py [dict.txt ...]
+'''
+
+HEADER = struct.Struct('<8sIIQ')
+MAGIC = b'JBPFDICT'
+
+
+def cachedir():
+    '''Directory for compiled dictionaries, the same as the scripts use.'''
+    path = os.environ.get('NLPUTILS_CACHE')
+    if not path:
+        path = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'), 'nlputils')
+    return path
+
+
+def cachefile(digest):
+    return os.path.join(cachedir(), 'jieba.%s.pfdict' % digest)
+
+
+def savepfdict(freq, total, filename):
+    '''Write the prefix dictionary `freq` to `filename` atomically.'''
+    keys = '\n'.join(freq).encode('utf-8')
+    freqs = array.array('Q', freq.values())
+    if sys.byteorder != 'little':
+        freqs.byteswap()
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmpname = tempfile.mkstemp(dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, len(freqs), len(keys), total))
+            f.write(keys)
+            f.write(freqs.tobytes())
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def loadpfdict(filename):
+    '''Load a compiled prefix dictionary. Returns (freq, total).'''
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        magic, count, keysize, total = HEADER.unpack_from(mm)
+        if magic != MAGIC:
+            raise ValueError('not a compiled prefix dictionary: %s' % filename)
+        start = HEADER.size + keysize
+        keys = str(mm[HEADER.size:start], 'utf-8').split('\n')
+        freqs = array.array('Q')
+        freqs.frombytes(mm[start:start + count * freqs.itemsize])
+    if sys.byteorder != 'little':
+        freqs.byteswap()
+    if len(keys) != count or len(freqs) != count:
+        raise ValueError('truncated prefix dictionary: %s' % filename)
+    return dict(zip(keys, freqs)), total
+
+
+def dictdigest(tokenizer):
+    '''SHA-1 of the dictionary of `tokenizer`, as used to name its cache.'''
+    with tokenizer.get_dict_file() as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def getpfdict(tokenizer):
+    '''
+    Get (freq, total) of the dictionary of `tokenizer`, from the cache if
+    possible, otherwise build it and save it to the cache.
+    '''
+    with tokenizer.get_dict_file() as f:
+        data = f.read()
+    filename = cachefile(hashlib.sha1(data).hexdigest())
+    try:
+        return loadpfdict(filename)
+    except (OSError, ValueError, struct.error):
+        pass
+    freq, total = tokenizer.gen_pfdict(io.BytesIO(data))
+    try:
+        savepfdict(freq, total, filename)
+    except OSError:
+        jieba.default_logger.exception("Dump cache file failed.")
+    return freq, total
+
+
+class Tokenizer(jieba.Tokenizer):
+    '''jieba.Tokenizer that uses the compiled dictionary cache.'''
+
+    def initialize(self, dictionary=None):
+        if dictionary:
+            abs_path = jieba._get_abs_path(dictionary)
+            if self.dictionary == abs_path and self.initialized:
+                return
+            self.dictionary = abs_path
+            self.initialized = False
+        with self.lock:
+            if self.initialized:
+                return
+            self.FREQ, self.total = getpfdict(self)
+            self.initialized = True
+
+
+if __name__ == '__main__':
+    for filename in (sys.argv[1:] or [None]):
+        dt = Tokenizer(filename)
+        dt.initialize()
+        print('%s: %d entries' % (filename or 'jieba default', len(dt.FREQ)))
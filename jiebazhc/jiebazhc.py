@@ -2,15 +2,13 @@
 # -*- coding: utf-8 -*-
 
 import os
-import jieba
+from .dictcache import Tokenizer
 
 _get_module_path = lambda path: os.path.normpath(os.path.join(os.getcwd(),
                                                               os.path.dirname(__file__), path))
 _get_abs_path = lambda path: os.path.normpath(os.path.join(os.getcwd(), path))
 
-dt = jieba.Tokenizer()
-
-dt.cache_file = "jiebazhc.cache"
+dt = Tokenizer()
 
 if os.path.isfile(_get_module_path("dict.txt")):
     dt.set_dictionary(_get_module_path("dict.txt"))
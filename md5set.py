@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import mmap
+import array
+import struct
+import hashlib
+import tempfile
+from fileutil import atomicwrite
+
+'''
+Compact set of MD5 digests, for lookups against hundreds of millions of
+hashes.
+
+The digests are kept sorted and deduplicated in one buffer of 16-byte
+records, about 16 bytes per hash instead of ~100 for a set of bytes. An
+index of where each 2-byte prefix starts narrows every lookup to a binary
+search over a few records. With numpy, the records are sorted in place
+and lookups can be batched. A compiled set is built through 256 bucket
+files by the first byte, so only one bucket is sorted in memory at a
+time.
+
+The compiled form is the header, the index and the records, and is
+memory-mapped when loaded:
+
+    python3 md5set.py wordlist.txt wordlist.md5set
+'''
+
+MD5SET_MAGIC = b'MD5SET\0\0'
+# magic, number of digests
+MD5SET_HEADER = struct.Struct('<8sQ')
+# records before each 2-byte prefix, and the total
+INDEX_SIZE = 65537
+
+md5digest = lambda s: hashlib.md5(s).digest()
+
+
+def _sortbucket(bucket):
+    '''Sort and deduplicate a bytearray of 16-byte records, in place if possible.'''
+    try:
+        import numpy as np
+    except ImportError:
+        return b''.join(sorted(set(
+            bytes(bucket[i:i+16]) for i in range(0, len(bucket), 16))))
+    arr = np.frombuffer(bucket, dtype='S16')
+    if len(arr) < 2:
+        return bucket
+    arr.sort()
+    keep = np.empty(len(arr), dtype=bool)
+    keep[0] = True
+    np.not_equal(arr[1:], arr[:-1], out=keep[1:])
+    if keep.all():
+        return bucket
+    unique = arr[keep]
+    count = len(unique)
+    arr[:count] = unique
+    # release the buffer before resizing it
+    del arr, keep, unique
+    del bucket[count * 16:]
+    return bucket
+
+
+def _buildindex(records, count, base=0):
+    '''The prefix index of `count` sorted records at `base` of `records`.'''
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    if np is not None and count:
+        # the 2-byte prefix of every record
+        prefixes = np.frombuffer(records, dtype='>u2', count=count * 8,
+                                 offset=base)[::8]
+        return array.array('Q', np.searchsorted(
+            prefixes, np.arange(INDEX_SIZE)).astype(np.uint64).tobytes())
+    index = array.array('Q', bytes(INDEX_SIZE * 8))
+    lo = 0
+    for prefix in range(65536):
+        # first record >= prefix
+        key = prefix.to_bytes(2, 'big')
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + mid * 16
+            if records[pos:pos+2] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        index[prefix] = lo
+    index[65536] = count
+    return index
+
+
+class MD5Set:
+    def __init__(self, records, index, count, base=0):
+        # records start at offset `base` of the buffer `records`
+        self.records = records
+        self.index = index
+        self.count = count
+        self.base = base
+
+    @classmethod
+    def build(cls, digests, filename=None):
+        '''
+        Build a set from an iterable of 16-byte digests. Other lengths are
+        ignored. If `filename` is given, the set is built there through
+        temporary bucket files and memory-mapped.
+        '''
+        if filename is None:
+            records = bytearray()
+            for d in digests:
+                if len(d) == 16:
+                    records += d
+            records = _sortbucket(records)
+            count = len(records) // 16
+            return cls(records, _buildindex(records, count), count)
+        dirname = os.path.dirname(os.path.abspath(filename))
+        with tempfile.TemporaryDirectory(dir=dirname) as tmpdir:
+            files = [open(os.path.join(tmpdir, '%02x' % i), 'w+b')
+                     for i in range(256)]
+            try:
+                for d in digests:
+                    if len(d) == 16:
+                        files[d[0]].write(d)
+                with atomicwrite(filename, 'w+b') as f:
+                    f.write(bytes(MD5SET_HEADER.size + INDEX_SIZE * 8))
+                    for bucket in files:
+                        records = bytearray(bucket.tell())
+                        bucket.seek(0)
+                        bucket.readinto(records)
+                        bucket.close()
+                        f.write(_sortbucket(records))
+                    records = None
+                    count = (f.tell() - MD5SET_HEADER.size - INDEX_SIZE * 8) // 16
+                    f.flush()
+                    with mmap.mmap(f.fileno(), 0) as mm:
+                        index = _buildindex(
+                            mm, count, MD5SET_HEADER.size + INDEX_SIZE * 8)
+                    if sys.byteorder != 'little':
+                        index.byteswap()
+                    f.seek(0)
+                    f.write(MD5SET_HEADER.pack(MD5SET_MAGIC, count))
+                    f.write(bytes(index))
+            finally:
+                for bucket in files:
+                    bucket.close()
+        return cls.load(filename)
+
+    @classmethod
+    def fromwords(cls, filename, output=None):
+        '''Build a set of the MD5 of each line in the file `filename`.'''
+        with open(filename, 'rb') as f:
+            return cls.build((md5digest(ln.rstrip(b'\n')) for ln in f), output)
+
+    @classmethod
+    def fromfile(cls, filename):
+        '''Load a compiled set, or build one from a word list.'''
+        with open(filename, 'rb') as f:
+            magic = f.read(len(MD5SET_MAGIC))
+        if magic == MD5SET_MAGIC:
+            return cls.load(filename)
+        return cls.fromwords(filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''Memory-map a compiled set.'''
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = MD5SET_HEADER.unpack_from(mm)
+        if magic != MD5SET_MAGIC:
+            raise ValueError('not a compiled md5 set: %s' % filename)
+        pos = MD5SET_HEADER.size
+        index = array.array('Q')
+        index.frombytes(mm[pos:pos + INDEX_SIZE * 8])
+        if sys.byteorder != 'little':
+            index.byteswap()
+        pos += INDEX_SIZE * 8
+        if len(mm) - pos < count * 16:
+            raise ValueError('truncated md5 set: %s' % filename)
+        return cls(mm, index, count, pos)
+
+    def save(self, filename):
+        '''Write the compiled set to `filename` atomically.'''
+        index = array.array('Q', self.index)
+        if sys.byteorder != 'little':
+            index.byteswap()
+        with atomicwrite(filename) as f:
+            f.write(MD5SET_HEADER.pack(MD5SET_MAGIC, self.count))
+            f.write(bytes(index))
+            with memoryview(self.records) as mv:
+                f.write(mv[self.base:self.base + self.count * 16])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        records = self.records
+        for i in range(self.base, self.base + self.count * 16, 16):
+            yield bytes(records[i:i+16])
+
+    def __contains__(self, digest):
+        if len(digest) != 16:
+            return False
+        records = self.records
+        prefix = digest[0] << 8 | digest[1]
+        lo = self.index[prefix]
+        hi = self.index[prefix + 1]
+        base = self.base
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos = base + mid * 16
+            record = records[pos:pos+16]
+            if record < digest:
+                lo = mid + 1
+            elif record == digest:
+                return True
+            else:
+                hi = mid
+        return False
+
+    def contains_many(self, digests):
+        '''Membership of each of a list of digests, as a list of bools.'''
+        try:
+            import numpy as np
+        except ImportError:
+            return [d in self for d in digests]
+        if not digests:
+            return []
+        valid = np.fromiter((len(d) == 16 for d in digests), dtype=bool,
+                            count=len(digests))
+        query = np.frombuffer(b''.join(
+            d if len(d) == 16 else bytes(16) for d in digests), dtype='S16')
+        if not self.count:
+            return [False] * len(digests)
+        records = np.frombuffer(self.records, dtype='S16', count=self.count,
+                                offset=self.base)
+        pos = np.searchsorted(records, query)
+        found = records[np.minimum(pos, self.count - 1)] == query
+        return (found & valid).tolist()
+
+
+if __name__ == '__main__':
+    MD5Set.fromwords(sys.argv[1], sys.argv[2])
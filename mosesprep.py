@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import itertools
+import multiprocessing
+import zhutil
+
+'''
+Add walls (and zones) between punctuations of whitespace-tokenized lines
+for Moses XML input.
+'''
+
+def walls(lines):
+    out = []
+    for ln in lines:
+        out.append(' '.join(zhutil.addwalls(ln.split())))
+        out.append('\n')
+    return ''.join(out)
+
+def wallzones(lines):
+    out = []
+    buf = []
+    for ln in lines:
+        out.append(' '.join(zhutil.addwallzone(ln.split(), buf)))
+        out.append('\n')
+    return ''.join(out)
+
+def blocks(stream, size):
+    while 1:
+        block = list(itertools.islice(stream, size))
+        if not block:
+            break
+        yield block
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Add walls and zones for Moses XML input.")
+    parser.add_argument("-z", "--zone", action="store_true",
+        help="also add zones between paired brackets")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of worker processes, 0 for all CPUs (default: 1)")
+    parser.add_argument("-b", "--block", type=int, default=10000,
+        help="lines per block (default: 10000)")
+    args = parser.parse_args()
+    func = wallzones if args.zone else walls
+    it = blocks(sys.stdin, args.block)
+    if args.jobs == 1:
+        for r in map(func, it):
+            sys.stdout.write(r)
+        return
+    with multiprocessing.Pool(args.jobs or None) as pool:
+        for r in pool.imap(func, it):
+            sys.stdout.write(r)
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,46 @@
 # This uses Python 3, but it's easy to port to Python 2 by changing
 # strings to u'xx'.
 
+import re
+import sys
+import argparse
+import functools
 import itertools
 
+_revuniq = lambda l: ''.join(k for k, g in itertools.groupby(reversed(l)))
+_n2c_groups = {}
+
+
+def _n2c_grouptable(c_basic, c_unit1, c_twoalt):
+    '''Renderings of all four-digit groups 0001-9999 for `num2chinese`.'''
+    key = (c_basic, c_unit1, c_twoalt)
+    table = _n2c_groups.get(key)
+    if table is not None:
+        return table
+    table = [c_basic[0]]
+    for num in range(1, 10000):
+        unit = '%04d' % num
+        ulist = []
+        for nc, ch in enumerate(reversed(unit)):
+            if ch == '0':
+                if ulist:  # ???0
+                    ulist.append(c_basic[0])
+            elif nc == 0:
+                ulist.append(c_basic[int(ch)])
+            elif nc == 1 and ch == '1' and unit[1] == '0':
+                # special case for tens
+                # edit the 'elif' if you don't like
+                # 十四, 三千零十四, 三千三百一十四
+                ulist.append(c_unit1[0])
+            elif nc > 1 and ch == '2':
+                ulist.append(c_twoalt + c_unit1[nc - 1])
+            else:
+                ulist.append(c_basic[int(ch)] + c_unit1[nc - 1])
+        table.append(_revuniq(ulist))
+    _n2c_groups[key] = table
+    return table
+
+
 def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
     """
     Converts numbers to Chinese representations.
@@ -40,7 +78,6 @@ def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
         else:
             c_twoalt = '二'
     c_unit2 = '万亿兆京垓秭穰沟涧正载' if simp else '萬億兆京垓秭穰溝澗正載'
-    revuniq = lambda l: ''.join(k for k, g in itertools.groupby(reversed(l)))
     nd = str(num)
     result = []
     if nd[0] == '+':
@@ -54,41 +91,67 @@ def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
     if int(integer):
         splitted = [integer[max(i - 4, 0):i]
                     for i in range(len(integer), 0, -4)]
+        groups = _n2c_grouptable(c_basic, c_unit1, c_twoalt)
         intresult = []
         for nu, unit in enumerate(splitted):
+            unit = int(unit)
             # special cases
-            if int(unit) == 0:  # 0000
+            if unit == 0:  # 0000
                 intresult.append(c_basic[0])
-                continue
-            elif nu > 0 and int(unit) == 2:  # 0002
+            elif nu > 0 and unit == 2:  # 0002
                 intresult.append(c_twoalt + c_unit2[nu - 1])
-                continue
-            ulist = []
-            unit = unit.zfill(4)
-            for nc, ch in enumerate(reversed(unit)):
-                if ch == '0':
-                    if ulist:  # ???0
-                        ulist.append(c_basic[0])
-                elif nc == 0:
-                    ulist.append(c_basic[int(ch)])
-                elif nc == 1 and ch == '1' and unit[1] == '0':
-                    # special case for tens
-                    # edit the 'elif' if you don't like
-                    # 十四, 三千零十四, 三千三百一十四
-                    ulist.append(c_unit1[0])
-                elif nc > 1 and ch == '2':
-                    ulist.append(c_twoalt + c_unit1[nc - 1])
-                else:
-                    ulist.append(c_basic[int(ch)] + c_unit1[nc - 1])
-            ustr = revuniq(ulist)
-            if nu == 0:
-                intresult.append(ustr)
+            elif nu == 0:
+                intresult.append(groups[unit])
             else:
-                intresult.append(ustr + c_unit2[nu - 1])
-        result.append(revuniq(intresult).strip(c_basic[0]))
+                intresult.append(groups[unit] + c_unit2[nu - 1])
+        result.append(_revuniq(intresult).strip(c_basic[0]))
     else:
         result.append(c_basic[0])
     if remainder:
         result.append(c_symbol[2])
         result.append(''.join(c_basic[int(ch)] for ch in remainder))
     return ''.join(result)
+
+
+# whole numbers only: not numbers with leading zeros (IDs, codes) or parts
+# of dotted runs (version numbers, IP addresses)
+re_number = re.compile(r'(?<![0-9])(?<![0-9]\.)(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?!\.?[0-9])')
+
+
+def makeconverter(big=False, simp=True, o=False, twoalt=False, cachesize=65536):
+    """
+    Make a function that rewrites all Arabic numerals in a text.
+
+    Conversions are cached. Numbers out of range, numbers with leading zeros
+    and dotted runs like 1.2.3 are left unchanged.
+    """
+    @functools.lru_cache(cachesize)
+    def convert(nd):
+        try:
+            return num2chinese(nd, big, simp, o, twoalt)
+        except ValueError:
+            return nd
+    repl = lambda m: convert(m.group())
+    return lambda s: re_number.sub(repl, s)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rewrite Arabic numerals in text to Chinese numbers.")
+    parser.add_argument("-b", "--big", action="store_true",
+        help="use financial characters")
+    parser.add_argument("-t", "--traditional", action="store_true",
+        help="use traditional characters")
+    parser.add_argument("-o", "--formal", action="store_true",
+        help="use 〇 for zero")
+    parser.add_argument("-2", "--twoalt", action="store_true",
+        help="use 两/兩 for two when appropriate")
+    args = parser.parse_args()
+    convert = makeconverter(
+        args.big, not args.traditional, args.formal, args.twoalt)
+    for ln in sys.stdin:
+        sys.stdout.write(convert(ln))
+
+
+if __name__ == '__main__':
+    main()
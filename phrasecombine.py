@@ -2,11 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import sys
+import argparse
+from dictrie import Trie, TRIE_MAGIC
 
 class PhraseCombiner:
-    def __init__(self, dictfile, char=''):
-        self.pfdic = {}
+    def __init__(self, dictfile, char='', compact=False):
+        # a prefix dict is fastest; a trie (`compact`, or compiled by
+        # `dictrie.py`) takes about a tenth of the memory
+        self.pfdic = self.trie = None
         self.char = char
+        with open(dictfile, 'rb') as f:
+            compiled = f.read(len(TRIE_MAGIC)) == TRIE_MAGIC
+        if compact or compiled:
+            self.trie = Trie.fromfile(dictfile)
+            return
+        self.pfdic = {}
         with open(dictfile, 'r') as f:
             for ln in f:
                 word = ln.strip()
@@ -16,6 +26,9 @@ class PhraseCombiner:
                 self.pfdic[word] = 1
 
     def combine(self, tokens):
+        if self.trie is not None:
+            return [tokens[start] if node < 0 else self.char.join(tokens[start:end])
+                    for start, end, node in self.trie.segment(tokens, self.char)]
         N = len(tokens)
         pos = 0
         res = []
@@ -38,13 +51,28 @@ class PhraseCombiner:
             res.append(maxph)
         return res
 
+    def combine_many(self, tokenlists):
+        if self.trie is None:
+            yield from map(self.combine, tokenlists)
+            return
+        for tokens, segments in self.trie.segmentmany(tokenlists, self.char):
+            yield [tokens[start] if node < 0 else self.char.join(tokens[start:end])
+                   for start, end, node in segments]
+
 
-def main(dictfile):
-    pc = PhraseCombiner(dictfile, '')
-    for ln in sys.stdin:
-        tks = ln.strip().split()
-        print(' '.join(pc.combine(tks)))
+def main():
+    parser = argparse.ArgumentParser(description="Combine splitted words in stdin to large phrases given a dictionary.")
+    parser.add_argument("-c", "--compile", metavar="FILE", help="compile the dictionary to FILE and exit")
+    parser.add_argument("-m", "--compact", action="store_true", help="match with a compact trie, slower but using much less memory (always for a compiled dictionary)")
+    parser.add_argument("dictfile", help="dictionary, one phrase per line, or a compiled one")
+    args = parser.parse_args()
+    pc = PhraseCombiner(args.dictfile, '', args.compact or bool(args.compile))
+    if args.compile:
+        pc.trie.save(args.compile)
+        return 0
+    for tks in pc.combine_many(ln.strip().split() for ln in sys.stdin):
+        print(' '.join(tks))
     return 0
 
 if __name__ == '__main__':
-    sys.exit(main(sys.argv[1]))
+    sys.exit(main())
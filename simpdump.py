@@ -1,11 +1,20 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import sys
+import json
+import mmap
+import time
+import shutil
 import hashlib
+import argparse
+import tempfile
+import itertools
 import collections
 import multiprocessing
+from fileutil import atomicwrite, lineranges, progress, imap_bounded
 
 '''
 This script tries to fvck these various esoteric hard-to-process
@@ -18,75 +27,220 @@ md5hash = lambda s: hashlib.md5(s.encode('utf-8')).hexdigest()
 
 seperators = ('\t', '----', '|', ',', None)
 
-re_ctrl = re.compile("[\x00-\x08\x0A-\x1F]+")
+re_ctrl = re.compile(b"[\x00-\x08\x0A-\x1F]+")
+# all contain '&emsp;'
 remove_str = (
-    u"用户组&emsp;:<span class='gray'>平民 (-1)",
-    u"<tr><td>用户IP&emsp;:<span class=gray>"
+    "用户组&emsp;:<span class='gray'>平民 (-1)",
+    "<tr><td>用户IP&emsp;:<span class=gray>"
 )
 
 re_whitespace = re.compile('[\t ]+')
 re_password = re.compile('^[ -~]{6,64}$')
-re_username_ext = re.compile(r'^\S{2,64}$', re.U)
 
-re_formats = collections.OrderedDict((
-    ('email', re.compile('^[A-Za-z0-9._-]+@[A-Za-z0-9-]+\.[A-Za-z0-9.-]{2,}$')),
-    ('md5', re.compile('^[A-Fa-f0-9]{32}$')),
-    ('username', re.compile(r'^[\w.]{2,64}$')),
-    ('password', re_password),
-    (None, None) # catch all username/nickname
-))
+# Field types, in order of precedence. A field is the first type that
+# matches and has not been found in the line yet. `username_ext` is the
+# catch-all username/nickname, so username and username_ext exclude each
+# other.
+FIELD_TYPES = ('email', 'md5', 'username', 'password', 'username_ext')
+F_EMAIL, F_MD5, F_USERNAME, F_PASSWORD, F_USERNAME_EXT = (1, 2, 4, 8, 16)
+F_ALL = 31
+# types checked on the stripped field
+F_STRIP = F_EMAIL | F_MD5 | F_USERNAME
+
+FIELD_PATTERNS = (
+    r'[A-Za-z0-9._-]+@[A-Za-z0-9-]+\.[A-Za-z0-9.-]{2,}$',
+    r'[A-Fa-f0-9]{32}$',
+    r'[A-Za-z0-9_.]{2,64}$',
+    r'[ -~]{6,64}$',
+    r'\S{2,64}$',
+)
+
+# Every type is an optional lookahead with an empty group, so one match
+# tells all the types a field matches.
+re_fields = re.compile(''.join('(?:(?=%s)()|)' % p for p in FIELD_PATTERNS))
+
+def _fieldtables():
+    masks = {}
+    for mask in range(F_ALL + 1):
+        groups = tuple('' if mask & (1 << i) else None
+                       for i in range(len(FIELD_TYPES)))
+        masks[groups] = mask
+    # lowest bit set -> (result key, types no longer looked for)
+    picks = [None]
+    for mask in range(1, F_ALL + 1):
+        bit = mask & -mask
+        if bit & (F_USERNAME | F_USERNAME_EXT):
+            picks.append(('username', F_USERNAME | F_USERNAME_EXT))
+        else:
+            picks.append((FIELD_TYPES[bit.bit_length() - 1], bit))
+    return masks, picks
+
+_fieldmasks, _fieldpicks = _fieldtables()
 
 def sanitize(s):
-    s = re_ctrl.sub('', s.strip())
+    s = re_ctrl.sub(b'', s.strip())
     try:
         s = s.decode('utf-8')
     except UnicodeDecodeError:
         s = s.decode('gbk', 'ignore')
-    for rm in remove_str:
-        s = s.replace(rm, '')
+    if '&emsp;' in s:
+        for rm in remove_str:
+            s = s.replace(rm, '')
     return s
 
+def classify(fields, columns=None):
+    '''
+    Assign types to `fields`. Email, md5 and username are matched on the
+    stripped field; password and username_ext too, unless no earlier type
+    is still looked for. The type bit of each field (0 for none) is
+    appended to `columns`, if given.
+    '''
+    fields_got = {}
+    remaining = F_ALL
+    match = re_fields.match
+    for f in fields:
+        if remaining & F_STRIP:
+            f = f.strip()
+        mask = _fieldmasks[match(f).groups()] & remaining
+        pick = _fieldpicks[mask]
+        if columns is not None:
+            columns.append(mask & -mask)
+        if pick:
+            key, found = pick
+            fields_got[key] = f
+            remaining &= ~found
+            if not remaining and columns is None:
+                break
+    return fields_got
+
+def splitfields(s):
+    '''
+    Split `s` by the first separator that gives at least 2 fields.
+    Returns (separator index, fields), or (-1, None).
+    '''
+    for i, sep in enumerate(seperators):
+        if sep:
+            if sep not in s:
+                continue
+            fields = list(filter(None, s.split(sep)))
+        else:
+            fields = list(filter(None, re_whitespace.split(s)))
+        if len(fields) >= 2:
+            return i, fields
+    return -1, None
+
 def try_formats(s):
     if not s:
         return
-    for sep in seperators:
-        if sep:
-            fields = filter(None, s.split(sep))
+    sepindex, fields = splitfields(s)
+    if fields:
+        return classify(fields)
+    if re_password.match(s):
+        return {'password': s}
+
+class Layout:
+    '''
+    A fixed line layout: a separator and a few variants of the types of
+    the columns. Lines that fit it are parsed exactly as `try_formats`
+    would, with one split and one small regex per column.
+    '''
+
+    def __init__(self, sepindex, variants):
+        self.sepindex = sepindex
+        self.sep = seperators[sepindex]
+        # earlier separators must not split the line
+        self.earlier = seperators[:sepindex]
+        self.variants = tuple(tuple(columns) for columns in variants)
+        # number of columns -> [[(strip, match, key) for each column]]
+        self.parsers = collections.defaultdict(list)
+        for columns in self.variants:
+            self.parsers[len(columns)].append(self._compile(columns))
+
+    @staticmethod
+    def _compile(columns):
+        parser = []
+        remaining = F_ALL
+        for bit in columns:
+            strip = bool(remaining & F_STRIP)
+            # must not be any type that takes precedence, and must be `bit`
+            before = remaining & (bit - 1) if bit else remaining
+            pattern = ''.join('(?!%s)' % FIELD_PATTERNS[i]
+                for i in range(len(FIELD_TYPES)) if before & (1 << i))
+            if bit:
+                key, found = _fieldpicks[bit]
+                pattern += '(?=%s)' % FIELD_PATTERNS[bit.bit_length() - 1]
+                remaining &= ~found
+            else:
+                key = None
+            parser.append((strip, re.compile(pattern).match, key))
+        return parser
+
+    def __str__(self):
+        return 'separator %r, columns %s' % (
+            self.sep or 'whitespace', ' or '.join(','.join(
+            FIELD_TYPES[bit.bit_length() - 1] if bit else '-'
+            for bit in columns) for columns in self.variants))
+
+    def parse(self, s):
+        '''Returns the fields of `s`, or None if it doesn't fit.'''
+        for sep in self.earlier:
+            if sep in s:
+                return None
+        if self.sep:
+            fields = list(filter(None, s.split(self.sep)))
         else:
-            fields = filter(None, re_whitespace.split(s))
-        if len(fields) < 2:
-            continue
-        for f in fields:
+            fields = list(filter(None, re_whitespace.split(s)))
+        for parser in self.parsers.get(len(fields), ()):
             fields_got = {}
-            flist = re_formats.copy()
-            for f in fields:
-                for ftype, regex in flist.items():
-                    if ftype:
-                        if ftype != 'password':
-                            f = f.strip()
-                        if regex.match(f):
-                            fields_got[ftype] = f
-                            break
-                    elif re_username_ext.match(f):
-                        fields_got['username'] = f
-                        break
-                else:
-                    continue
-                del flist[ftype]
-                if ftype is None:
-                    try:
-                        del flist['username']
-                    except KeyError:
-                        pass
-                elif ftype == 'username':
-                    try:
-                        del flist[None]
-                    except KeyError:
-                        pass
-            return fields_got
-    else:
-        if re_password.match(s):
-            return {'password': s}
+            for f, (strip, match, key) in zip(fields, parser):
+                if strip:
+                    f = f.strip()
+                if not match(f):
+                    break
+                if key:
+                    fields_got[key] = f
+            else:
+                return fields_got
+        return None
+
+def sniff(lines, minfit=.9, maxvariants=4):
+    '''
+    Find the encoding and the most common layout of `lines`.
+    Returns (encoding, Layout or None, fraction of lines that fit).
+    '''
+    encodings = collections.Counter()
+    layouts = collections.Counter()
+    for ln in lines:
+        try:
+            ln.decode('utf-8')
+            encodings['utf-8'] += 1
+        except UnicodeDecodeError:
+            encodings['gbk'] += 1
+        sepindex, fields = splitfields(sanitize(ln))
+        if fields:
+            columns = []
+            classify(fields, columns)
+            layouts[sepindex, tuple(columns)] += 1
+    encoding = encodings.most_common(1)[0][0] if encodings else 'utf-8'
+    if not layouts:
+        return encoding, None, 0
+    seps = collections.Counter()
+    for (sepindex, columns), count in layouts.items():
+        seps[sepindex] += count
+    sepindex = seps.most_common(1)[0][0]
+    variants = []
+    count = 0
+    for (i, columns), n in layouts.most_common():
+        if i != sepindex or not any(columns):
+            continue
+        variants.append(columns)
+        count += n
+        if count >= minfit * len(lines) or len(variants) >= maxvariants:
+            break
+    fit = count / len(lines)
+    if fit < minfit:
+        return encoding, None, fit
+    return encoding, Layout(sepindex, variants), fit
 
 def process_result(r):
     password = r.get('password', '')
@@ -106,14 +260,221 @@ def process_result(r):
 def process_line(l):
     r = try_formats(sanitize(l))
     if r:
-        return u'\t'.join(process_result(r)).encode('utf-8')
+        return '\t'.join(process_result(r)).encode('utf-8')
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1 and sys.argv[1] == '-1':
-        func = map
-    else:
-        pool = multiprocessing.Pool()
-        func = lambda fn, it: pool.imap_unordered(fn, it, 256)
-    for result in func(process_line, sys.stdin):
+_layout = None
+
+def process_line_layout(l):
+    '''Like `process_line`, with the fast path. Returns (fit, result).'''
+    s = sanitize(l)
+    r = _layout.parse(s)
+    fit = r is not None
+    if not fit:
+        r = try_formats(s)
+    if r:
+        return fit, '\t'.join(process_result(r)).encode('utf-8')
+    return fit, None
+
+def initworker(layout):
+    global _layout
+    _layout = layout
+
+def process_range(args):
+    '''
+    Process the lines of `filename` in [start, end) and write the results to
+    `shard`. Returns (lines, lines that fit the layout).
+    '''
+    filename, start, end, shard = args
+    total = fits = 0
+    with open(filename, 'rb') as f, open(shard, 'wb', 1 << 20) as w:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        mm.seek(start)
+        readline = mm.readline
+        write = w.write
+        while mm.tell() < end:
+            l = readline()
+            total += 1
+            if _layout:
+                fit, result = process_line_layout(l)
+                fits += fit
+            else:
+                result = process_line(l)
+            if result:
+                write(result + b'\n')
+        mm.close()
+    return total, fits
+
+def copyfile(src, dst):
+    '''Append the file `src` to the file object `dst`, in the kernel if possible.'''
+    with open(src, 'rb') as f:
+        infd = f.fileno()
+        outfd = dst.fileno()
+        size = os.fstat(infd).st_size
+        copies = []
+        if hasattr(os, 'copy_file_range'):
+            copies.append(lambda offset: os.copy_file_range(infd, outfd, size - offset, offset))
+        if hasattr(os, 'sendfile'):
+            copies.append(lambda offset: os.sendfile(outfd, infd, offset, size - offset))
+        offset = 0
+        for copy in copies:
+            try:
+                while offset < size:
+                    n = copy(offset)
+                    if not n:
+                        break
+                    offset += n
+            except OSError:
+                # not supported between these files
+                if offset:
+                    raise
+                continue
+            break
+        if offset < size:
+            f.seek(offset)
+            shutil.copyfileobj(f, dst)
+            dst.flush()
+
+def loadcheckpoint(filename, source):
+    '''
+    The state saved in the checkpoint `filename` for the input file `source`,
+    or a new state if there is none. The state is the input offset up to which results have
+    been written, and the output size at that point.
+    '''
+    st = os.stat(source)
+    state = {'input': os.path.abspath(source), 'size': st.st_size,
+             'mtime_ns': st.st_mtime_ns, 'offset': 0, 'output': 0,
+             'lines': 0, 'fits': 0}
+    if not filename:
+        return state
+    try:
+        with open(filename, 'r') as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return state
+    for key in ('input', 'size', 'mtime_ns'):
+        if saved.get(key) != state[key]:
+            raise ValueError('%s is a checkpoint of another input file' % filename)
+    return saved
+
+def savecheckpoint(filename, state):
+    with atomicwrite(filename, 'w') as f:
+        json.dump(state, f)
+
+def process_file(filename, out, layout, jobs, block, state, checkpoint=None, tmpdir=None):
+    '''
+    Process `filename` in newline-aligned byte ranges, from the offset in
+    `state`. Each worker writes the results of a range to a shard file in
+    `tmpdir`, which is then appended to `out` by the kernel, so neither the
+    lines nor the results pass through pipes. At most 2 ranges per worker
+    are outstanding, to bound the shards waiting behind a slow range.
+    `state` is updated after each range and saved to `checkpoint`, if
+    given, once the output is synced.
+    '''
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = state['offset']
+        block = max(1 << 20, min(block, (len(mm) - start) // (jobs * 4) + 1))
+        spans = list(lineranges(mm, block, start))
+        mm.close()
+    out.flush()
+    report = sys.stderr.isatty()
+    starttime = time.monotonic()
+    with tempfile.TemporaryDirectory(prefix='simpdump.', dir=tmpdir) as tmpdir:
+        tasks = [(filename, start, end, os.path.join(tmpdir, '%d.out' % i))
+                 for i, (start, end) in enumerate(spans)]
+        with multiprocessing.Pool(jobs, initworker, (layout,)) as pool:
+            results = imap_bounded(pool, process_range, tasks, jobs * 2)
+            for task, (n, nfit) in zip(tasks, results):
+                state['output'] += os.path.getsize(task[3])
+                copyfile(task[3], out)
+                os.unlink(task[3])
+                state['offset'] = task[2]
+                state['lines'] += n
+                state['fits'] += nfit
+                if checkpoint:
+                    os.fsync(out.fileno())
+                    savecheckpoint(checkpoint, state)
+                if report:
+                    progress('simpdump', state['offset'], state['size'], start, starttime)
+            pool.close()
+            pool.join()
+    if report and tasks:
+        sys.stderr.write('\n')
+
+def write_results(results, out, layout):
+    '''Write `results` of `process_line(_layout)`. Returns (lines, lines that fit the layout).'''
+    total = fits = 0
+    if not layout:
+        for result in results:
+            if result:
+                out.write(result + b'\n')
+        return total, fits
+    for fit, result in results:
+        total += 1
+        fits += fit
         if result:
-            print(result)
+            out.write(result + b'\n')
+    return total, fits
+
+def main():
+    global _layout
+    parser = argparse.ArgumentParser(description="Find username, email, password and hash from leaked password dumps.")
+    parser.add_argument("-1", dest="single", action="store_true", help="use a single process")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="number of worker processes, 0 for all CPUs (default: 0)")
+    parser.add_argument("-b", "--block", type=int, default=64, help="MiB of the input file per worker task (default: 64)")
+    parser.add_argument("-s", "--sample", type=int, default=1000, help="lines to sample for the file layout, 0 to disable the fast path (default: 1000)")
+    parser.add_argument("-o", "--output", help="output file (default: stdout)")
+    parser.add_argument("-c", "--checkpoint", help="record progress of the input file in this file, and resume from it")
+    parser.add_argument("file", nargs="?", help="input file, memory-mapped and processed in blocks (default: stdin)")
+    args = parser.parse_args()
+    stream = open(args.file, 'rb') if args.file else sys.stdin.buffer
+    state = None
+    if args.checkpoint:
+        if not (args.file and args.output):
+            parser.error('a checkpoint needs an input file and an output file')
+        try:
+            state = loadcheckpoint(args.checkpoint, args.file)
+        except (OSError, ValueError) as ex:
+            parser.error(str(ex))
+    if state and state['output']:
+        # drop results written after the checkpoint
+        out = open(args.output, 'r+b')
+        if os.fstat(out.fileno()).st_size < state['output']:
+            parser.error('%s is shorter than in the checkpoint' % args.output)
+        out.truncate(state['output'])
+        out.seek(state['output'])
+    else:
+        out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    sample = list(itertools.islice(stream, args.sample))
+    encoding, _layout, fit = sniff(sample) if sample else ('utf-8', None, 0)
+    if args.sample:
+        sys.stderr.write('simpdump: %s, %s (%.1f%% of %d sampled lines)\n' % (
+            encoding, _layout or 'no fixed layout', fit * 100, len(sample)))
+    jobs = 1 if args.single else (args.jobs or os.cpu_count())
+    if args.file and (jobs > 1 or state) and os.path.isfile(args.file) and os.path.getsize(args.file):
+        stream.close()
+        if state is None:
+            state = loadcheckpoint(None, args.file)
+        # shards go next to the output, not to a possibly small /tmp
+        tmpdir = os.path.dirname(os.path.abspath(args.output)) if args.output else None
+        process_file(args.file, out, _layout, jobs, args.block << 20, state,
+                     args.checkpoint, tmpdir)
+        total, fits = state['lines'], state['fits']
+    else:
+        lines = itertools.chain(sample, stream)
+        func = process_line_layout if _layout else process_line
+        if jobs == 1:
+            total, fits = write_results(map(func, lines), out, _layout)
+        else:
+            with multiprocessing.Pool(jobs, initworker, (_layout,)) as pool:
+                total, fits = write_results(
+                    pool.imap_unordered(func, lines, 256), out, _layout)
+                pool.close()
+                pool.join()
+    if _layout:
+        sys.stderr.write('simpdump: %d lines, %d fixed layout, %d fallback\n' % (
+            total, fits, total - fits))
+
+if __name__ == '__main__':
+    main()
@@ -3,12 +3,24 @@
 
 import sys, os
 import re
-import jieba
+import marshal
+import hashlib
+import argparse
+import itertools
+import collections
+import multiprocessing
+from jiebazhc.dictcache import Tokenizer, dictdigest
+from fileutil import atomicwrite
 #from zhconv import convert_for_mw
 from zhutil import *
 
 '''
 This script reads stdin, filters non-chinese sentences and cuts sentences and words.
+
+    splitrecutfilter.py [-j JOBS] [-b BLOCK] [noop|zhc]
+
+Without a mode, words are cut by jieba; 'noop' only cuts sentences, any other
+mode uses the Classical Chinese dictionary (jiebazhc).
 '''
 
 punctstr = (
@@ -24,8 +36,8 @@ brackets = '()（）[]""‘’“”{}〈〉《》「」『』【】〔〕〖〗
 _get_module_path = lambda path: os.path.normpath(os.path.join(os.getcwd(),
                                                  os.path.dirname(__file__), path))
 
-jiebazhc = jieba.Tokenizer(_get_module_path('zhcdict.txt'))
-jiebazhc.cache_file = "jiebazhc.cache"
+jiebadt = Tokenizer()
+jiebazhc = Tokenizer(_get_module_path('zhcdict.txt'))
 
 #RE_BRACKETS = re.compile(' ?\((.*?)\)| ?\((.*?)\)')
 RE_BRACKETS = re.compile('|'.join(' ?%s.*?%s' % (re.escape(brackets[i]), re.escape(brackets[i+1])) for i in range(0, len(brackets), 2)))
@@ -33,42 +45,225 @@ RE_BRACKETS = re.compile('|'.join(' ?%s.*?%s' % (re.escape(brackets[i]), re.esca
 tailp = frozenset("""([{£¥`〈《「『【〔〖（［｛￡￥〝︵︷︹︻︽︿﹁﹃﹙﹛﹝（｛"'“‘""")
 stripblank = lambda s: s.replace(' ', '').replace('\u3000', '')
 
-if len(sys.argv) > 1:
-	if sys.argv[1] == 'noop':
+cut = lambda s: jiebadt.cut(s, HMM=False)
+
+def setmode(mode):
+	global cut, stripblank
+	if mode == 'noop':
 		cut = lambda s: (s,)
 		stripblank = lambda s: s.replace('\u3000', ' ')
-	else:
+	elif mode:
 		cut = lambda s: jiebazhc.cut(s, HMM=False)
-else:
-	cut = lambda s: jieba.cut(s, HMM=False)
+	else:
+		cut = lambda s: jiebadt.cut(s, HMM=False)
+
+def initworker(mode):
+	setmode(mode)
+	if isinstance(cutsent, SegCache):
+		cutsent.resetstats()
+	if mode == 'noop':
+		return
+	elif mode:
+		jiebazhc.initialize()
+	else:
+		jiebadt.initialize()
 
-notchinese = lambda l: not l or sum((ord(i) not in ucjk) for i in l) > .5 * len(l)
+notchinese = lambda l: not l or len(l) - countucjk(l) > .5 * len(l)
 brcksub = lambda matchobj: '' if notchinese(matchobj.group(0)[1:-1]) else matchobj.group(0)
 
+def cutsentence(s):
+	l = RE_BRACKETS.sub(brcksub, s)
+	if notchinese(l):
+		return None
+	return ' '.join(cut(l.replace('「', '“').replace('」', '”').replace('『', '‘').replace('』', '’').lstrip(tailpunct).rstrip(headpunct)))
+
+class SegCache:
+	'''
+	LRU cache of `cutsentence` results, keyed by a 128-bit BLAKE2 hash of the
+	sentence and limited to about `maxbytes` of memory. A saved cache is only
+	loaded back with the same format version and `tag`.
+	'''
+	# saved cache format
+	version = 2
+	# dict entry, key bytes object and hash
+	entrysize = 120
+
+	def __init__(self, func, maxbytes, tag=''):
+		self.func = func
+		self.maxbytes = maxbytes
+		self.tag = tag
+		self.cache = collections.OrderedDict()
+		self.size = 0
+		# new entries to send back to the parent process, if not None
+		self.added = None
+		self.resetstats()
+
+	def resetstats(self):
+		self.hits = self.misses = self.saved = 0
+
+	def stats(self):
+		return (self.hits, self.misses, self.saved)
+
+	def __call__(self, s):
+		b = s.encode('utf-8', 'surrogatepass')
+		key = hashlib.blake2b(b, digest_size=16).digest()
+		try:
+			value = self.cache[key]
+		except KeyError:
+			self.misses += 1
+			value = self.func(s)
+			self.put(key, value)
+			if self.added is not None:
+				self.added.append((key, value))
+			return value
+		self.cache.move_to_end(key)
+		self.hits += 1
+		self.saved += len(b)
+		return value
+
+	def put(self, key, value):
+		if key in self.cache:
+			return
+		self.cache[key] = value
+		self.size += self.entrysize + sys.getsizeof(value)
+		while self.size > self.maxbytes and self.cache:
+			key, value = self.cache.popitem(last=False)
+			self.size -= self.entrysize + sys.getsizeof(value)
+
+	def load(self, filename):
+		try:
+			with open(filename, 'rb') as f:
+				data = marshal.load(f)
+		except FileNotFoundError:
+			return
+		except (EOFError, ValueError, TypeError):
+			data = None
+		if not isinstance(data, tuple) or len(data) != 3 or data[:2] != (self.version, self.tag):
+			return
+		for key, value in data[2]:
+			self.put(key, value)
+
+	def save(self, filename):
+		with atomicwrite(filename) as f:
+			marshal.dump((self.version, self.tag, list(self.cache.items())), f)
+
+cutsent = cutsentence
+
 def cutandsplit(s):
 	for ln in filterlist(splitsentence(stripblank(s))):
-		l = RE_BRACKETS.sub(brcksub, ln.strip())
-		if notchinese(l):
-			continue
-		yield ' '.join(cut(l.replace('「', '“').replace('」', '”').replace('『', '‘').replace('』', '’').lstrip(tailpunct).rstrip(headpunct)))
+		l = cutsent(ln.strip())
+		if l is not None:
+			yield l
 
 cutfilter = lambda s: ' '.join(i.strip() for i in cut(s.replace(' ', '')))
 
-lastline = ''
-
-for ln in sys.stdin:
+def cleanline(ln):
 	l = ln.strip(' \t\n\r\x0b\x0c\u3000=[]')
-	if not l or all((ord(i) not in ucjk) for i in l) or any((ord(i) in range(32)) for i in l):
-		continue
-	elif l[-1] in tailp:
-		lastline += l
+	if not l or not anyucjk(l) or hasctrl(l):
+		return None
+	return l
+
+def process(lines):
+	lastline = ''
+	for ln in lines:
+		l = cleanline(ln)
+		if l is None:
+			continue
+		elif l[-1] in tailp:
+			lastline += l
+		else:
+			#yield '\n'.join(filterlist((splitsentence(cutfilter(lastline + l))))) + '\n'
+			yield '\n'.join(cutandsplit(lastline + l)) + '\n'
+			lastline = ''
+	if lastline:
+		#yield '\n'.join(filterlist((splitsentence(cutfilter(lastline))))) + '\n'
+		yield '\n'.join(cutandsplit(lastline)) + '\n'
+
+def processblock(lines):
+	text = ''.join(process(lines))
+	if not isinstance(cutsent, SegCache):
+		return text, None, None
+	stats = cutsent.stats()
+	cutsent.resetstats()
+	added = cutsent.added
+	if added is not None:
+		cutsent.added = []
+	return text, stats, added
+
+def blocks(stream, size):
+	'''
+	Read `stream` in blocks of about `size` lines. Each block ends with a line
+	that is not joined with the next one, so blocks can be processed
+	independently.
+	'''
+	rest = []
+	while 1:
+		block = list(itertools.islice(stream, size))
+		if not block:
+			break
+		for i in range(len(block) - 1, -1, -1):
+			l = cleanline(block[i])
+			if l is not None and l[-1] not in tailp:
+				yield rest + block[:i+1]
+				rest = block[i+1:]
+				break
+		else:
+			rest.extend(block)
+	if rest:
+		yield rest
+
+def main():
+	parser = argparse.ArgumentParser(description="Filter non-chinese sentences, cut sentences and words.")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes, 0 for all CPUs (default: 1)")
+	parser.add_argument("-b", "--block", type=int, default=10000, help="lines per block (default: 10000)")
+	parser.add_argument("-c", "--cache", type=float, default=64, help="segmentation cache size per process in MiB, 0 to disable (default: 64)")
+	parser.add_argument("-C", "--cache-file", help="load the segmentation cache from and save it to this file")
+	parser.add_argument("-s", "--stats", action="store_true", help="print cache statistics to stderr")
+	parser.add_argument("mode", nargs='?', help="'noop' to only cut sentences, anything else to use jiebazhc (default: jieba)")
+	args = parser.parse_args()
+	global cutsent
+	setmode(args.mode)
+	cache = None
+	if args.cache > 0:
+		cache = cutsent = SegCache(cutsentence, int(args.cache * 1048576))
+		if args.cache_file:
+			# segmentations are only valid for the same mode and dictionary
+			if args.mode == 'noop':
+				cache.tag = 'noop'
+			else:
+				cache.tag = '%s:%s' % (args.mode or '', dictdigest(jiebazhc if args.mode else jiebadt))
+			cache.load(args.cache_file)
+	stats = [0, 0, 0]
+	if args.jobs == 1:
+		for text in process(sys.stdin):
+			sys.stdout.write(text)
 	else:
-		#sys.stdout.write('\n'.join(filterlist((splitsentence(cutfilter(lastline + l))))) + '\n')
-		sys.stdout.write('\n'.join(cutandsplit(lastline + l)))
-		sys.stdout.write('\n')
-		lastline = ''
-
-if lastline:
-	#sys.stdout.write('\n'.join(filterlist((splitsentence(cutfilter(lastline))))) + '\n')
-	sys.stdout.write('\n'.join(cutandsplit(lastline)))
-	sys.stdout.write('\n')
+		# load the dictionary and cache before forking, so workers share them
+		initworker(args.mode)
+		if cache and args.cache_file:
+			cache.added = []
+		with multiprocessing.Pool(args.jobs or None, initworker, (args.mode,)) as pool:
+			if cache:
+				cache.added = None
+			for text, blockstats, added in pool.imap(processblock, blocks(sys.stdin, args.block)):
+				sys.stdout.write(text)
+				if blockstats:
+					stats = [a + b for a, b in zip(stats, blockstats)]
+				if added:
+					for key, value in added:
+						cache.put(key, value)
+			pool.close()
+			pool.join()
+	if cache is None:
+		return
+	if args.cache_file:
+		cache.save(args.cache_file)
+	if args.stats:
+		if args.jobs == 1:
+			stats = cache.stats()
+		hits, misses, saved = stats
+		sys.stderr.write('segmentation cache: %d/%d hits (%.1f%%), %d bytes saved\n' % (
+			hits, hits + misses, hits * 100 / max(hits + misses, 1), saved))
+
+if __name__ == '__main__':
+	main()
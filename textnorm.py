@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import argparse
+import zhutil
+
+'''
+Normalize Chinese text from stdin line by line in a single pass:
+full-width to half-width, control character removal, GBK PUA conversion
+and whitespace detokenization.
+'''
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Normalize Chinese text in one pass.")
+    parser.add_argument("-F", "--no-fw2hw", action="store_true",
+        help="don't convert full-width ASCII to half-width")
+    parser.add_argument("-C", "--no-ctrl", action="store_true",
+        help="don't remove control characters")
+    parser.add_argument("-G", "--no-gbkpua", action="store_true",
+        help="don't convert GBK PUA codes")
+    parser.add_argument("-D", "--no-detokenize", action="store_true",
+        help="don't remove whitespace between Chinese characters")
+    parser.add_argument("-o", metavar='FILE', help="output file")
+    parser.add_argument("file", nargs='*', help="input files")
+    args = parser.parse_args()
+    normalize = zhutil.makenormalizer(
+        not args.no_fw2hw, not args.no_ctrl,
+        not args.no_gbkpua, not args.no_detokenize)
+    wstream = open(args.o, 'w', encoding='utf-8') if args.o else sys.stdout
+    with wstream:
+        for filename in (args.file or ['-']):
+            with (open(filename, 'r', encoding='utf-8') if filename != '-'
+                  else sys.stdin) as f:
+                for ln in f:
+                    wstream.write(normalize(ln.rstrip('\n')) + '\n')
+
+if __name__ == '__main__':
+    main()
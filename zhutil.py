@@ -3,23 +3,39 @@
 
 import os
 import re
+import sys
+import mmap
+import struct
 import itertools
+from fileutil import atomicwrite
 
 '''
 Various functions for processing Chinese text.
 '''
 
 halfwidth = frozenset('!(),:;?')
-fullwidth = frozenset(itertools.chain(
-    range(0xFF02, 0xFF07 + 1),
-    (0xFF0A, 0xFF0B, 0xFF0E, 0xFF0F, 0xFF1C, 0xFF1D,
-     0xFF1E, 0xFF3C, 0xFF3E, 0xFF3F, 0xFF40),
-    range(0xFF10, 0xFF19 + 1),
-    range(0xFF20, 0xFF3A + 1),
-    range(0xFF41, 0xFF5A + 1)))
+fullwidthranges = (
+    (0xFF02, 0xFF07),
+    (0xFF0A, 0xFF0B), (0xFF0E, 0xFF0F), (0xFF1C, 0xFF1E),
+    (0xFF3C, 0xFF3C), (0xFF3E, 0xFF40),
+    (0xFF10, 0xFF19),
+    (0xFF20, 0xFF3A),
+    (0xFF41, 0xFF5A)
+)
 resentencesp = re.compile('([﹒﹔﹖﹗．；。！？]["’”」』]{0,2}|：(?=["‘“「『]{1,2}|$))')
 refixmissing = re.compile(
     '(^[^"‘“「『’”」』，；。！？]+["’”」』]|^["‘“「『]?[^"‘“「『’”」』]+[，；。！？][^"‘“「『‘“「『]*["’”」』])(?!["‘“「『’”」』，；。！？])')
+# refixmissing backtracks badly on long lines; `fixmissing` uses the
+# equivalent linear scanner `fixmissingpos` built on these runs.
+_FM_QUOTES = '"‘“「『’”」』'
+_FM_OPEN = frozenset('"‘“「『')
+_FM_CLOSE = frozenset('"’”」』')
+_FM_QUOTEPUNCT = frozenset(_FM_QUOTES + '，；。！？')
+_RE_FM_NOTQUOTEPUNCT = re.compile('[^%s，；。！？]*' % _FM_QUOTES)
+_RE_FM_NOTQUOTE = re.compile('[^%s]*' % _FM_QUOTES)
+_RE_FM_NOTOPEN = re.compile('[^"‘“「『]*')
+_RE_FM_PUNCT = re.compile('[，；。！？]')
+_RE_FM_CLOSE = re.compile('["’”」』]')
 
 punctstr = (
     '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~¢£¥·ˇˉ―‖‘’“”•′‵、。々'
@@ -37,26 +53,78 @@ tailpunct = ('''!),-.:;?]}¢·ˇˉ―‖’”•′■□△○●'''
              '''﹐﹒﹔﹕﹖﹗﹚﹜﹞！），．：；？｜］｝～､￠''') + whitespace
 headpunct = ('''([`{£¥‘“〈《「『【〔〖〝'''
              '''︵︷︹︻︽︿﹁﹃﹙﹛﹝（［｛￡￥''') + whitespace
+_tailpunctset = frozenset(tailpunct)
+_headpunctset = frozenset(headpunct)
 
 openbrckt = ('([{（［｛⦅〚⦃“‘‹«「〈《【〔⦗『〖〘｢⟦⟨⟪⟮⟬⌈⌊⦇⦉❛❝❨❪❴❬❮❰❲'
              '⏜⎴⏞〝︵⏠﹁﹃︹︻︗︿︽﹇︷〈⦑⧼﹙﹛﹝⁽₍⦋⦍⦏⁅⸢⸤⟅⦓⦕⸦⸨｟⧘⧚⸜⸌⸂⸄⸉᚛༺༼')
 clozbrckt = (')]}）］｝⦆〛⦄”’›»」〉》】〕⦘』〗〙｣⟧⟩⟫⟯⟭⌉⌋⦈⦊❜❞❩❫❵❭❯❱❳'
              '⏝⎵⏟〞︶⏡﹂﹄︺︼︘﹀︾﹈︸〉⦒⧽﹚﹜﹞⁾₎⦌⦎⦐⁆⸣⸥⟆⦔⦖⸧⸩｠⧙⧛⸝⸍⸃⸅⸊᚜༻༽')
+brcktpair = dict(zip(openbrckt, clozbrckt))
+
+ucjkranges = (
+    (0x1100, 0x11FF),
+    (0x2E80, 0xA4CF),
+    (0xA840, 0xA87F),
+    (0xAC00, 0xD7AF),
+    (0xF900, 0xFAFF),
+    (0xFE30, 0xFE4F),
+    (0xFF65, 0xFFDC),
+    (0xFF01, 0xFF0F),
+    (0xFF1A, 0xFF20),
+    (0xFF3B, 0xFF40),
+    (0xFF5B, 0xFF60),
+    (0x20000, 0x2FFFF)
+)
+
+# Character class bits in `charclass`, a table indexed by codepoint.
+# Codepoints not covered by the table have no class.
+CC_UCJK = 1
+CC_FULLWIDTH = 2
+
+
+def _makecharclass():
+    table = bytearray(0x30000)
+    for flag, ranges in ((CC_UCJK, ucjkranges),
+                         (CC_FULLWIDTH, fullwidthranges)):
+        setflag = bytes(i | flag for i in range(256))
+        for start, end in ranges:
+            table[start:end + 1] = table[start:end + 1].translate(setflag)
+    return table
+
+charclass = _makecharclass()
+
+
+class CharClassSet:
+    '''Read-only set of codepoints backed by a class bit of `charclass`.'''
 
-ucjk = frozenset(itertools.chain(
-    range(0x1100, 0x11FF + 1),
-    range(0x2E80, 0xA4CF + 1),
-    range(0xA840, 0xA87F + 1),
-    range(0xAC00, 0xD7AF + 1),
-    range(0xF900, 0xFAFF + 1),
-    range(0xFE30, 0xFE4F + 1),
-    range(0xFF65, 0xFFDC + 1),
-    range(0xFF01, 0xFF0F + 1),
-    range(0xFF1A, 0xFF20 + 1),
-    range(0xFF3B, 0xFF40 + 1),
-    range(0xFF5B, 0xFF60 + 1),
-    range(0x20000, 0x2FFFF + 1)
-))
+    __slots__ = ('flag',)
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def __contains__(self, cp):
+        try:
+            return cp >= 0 and bool(charclass[cp] & self.flag)
+        except (IndexError, TypeError):
+            return False
+
+    def __iter__(self):
+        flag = self.flag
+        return (cp for cp, c in enumerate(charclass) if c & flag)
+
+    def __len__(self):
+        mask = bytes(i & self.flag for i in range(256))
+        return len(charclass) - charclass.translate(mask).count(0)
+
+ucjk = CharClassSet(CC_UCJK)
+fullwidth = CharClassSet(CC_FULLWIDTH)
+
+_charclassre = lambda ranges: ''.join(
+    '%s-%s' % (re.escape(chr(start)), re.escape(chr(end)))
+    for start, end in ranges)
+_RE_UCJKCHARS = re.compile('[%s]+' % _charclassre(ucjkranges))
+RE_C0CTRL = re.compile('[\000-\037]')
 
 zhmodel = None
 _curpath = os.path.normpath(
@@ -90,20 +158,139 @@ RE_CTRL = re.compile("[\000-\037\ufeff]+")
 hasucjk = lambda s: RE_UCJK.search(s)
 removectrl = lambda s: RE_CTRL.sub('', s)
 
+
+def countucjk(s):
+    '''Count the characters of `s` in `ucjk`.'''
+    return len(s) - len(_RE_UCJKCHARS.sub('', s))
+
+
+def ratioucjk(s):
+    '''Fraction of the characters of `s` in `ucjk`.'''
+    return countucjk(s) / len(s) if s else 0.
+
+
+anyucjk = lambda s: _RE_UCJKCHARS.search(s) is not None
+hasctrl = lambda s: RE_C0CTRL.search(s) is not None
+
+
 detokenize = lambda s: RE_WS_IN_FW.sub(r'\1', s).strip()
 detokenize.__doc__ = 'Detokenization function for Chinese.'
 
+def splitspans(sentence):
+    '''Like `splitsentence`, but return (start, end) spans into the string.'''
+    s = sentence
+    spans = []
+    pos = 0
+    for m in resentencesp.finditer(s):
+        start, end = m.span()
+        # a whole piece of '：' or '：\n' also matches resentencesp
+        if not spans or start > pos and not (
+                s[pos] == '：' and (start - pos == 1 or
+                start - pos == 2 and s[pos + 1] == '\n')):
+            spans.append((pos, end))
+        else:
+            spans[-1] = (spans[-1][0], end)
+        pos = end
+    if pos < len(s):
+        spans.append((pos, len(s)))
+    return spans
+
+
 def splitsentence(sentence):
     '''Split a piece of Chinese into sentences.'''
-    # s = ''.join((chr(ord(ch)+0xFEE0) if ch in halfwidth else ch) for ch in sentence)
-    s = sentence
-    slist = []
-    for i in resentencesp.split(s):
-        if resentencesp.match(i) and slist:
-            slist[-1] += i
-        elif i:
-            slist.append(i)
-    return slist
+    return [sentence[start:end] for start, end in splitspans(sentence)]
+
+
+class SentenceSplitter:
+    '''
+    Incremental `splitsentence` for text that arrives in chunks.
+
+    `feed` returns the sentences completed so far and `close` returns the
+    rest; together they give the same result as `splitsentence` on the whole text.
+    If `maxchar` is set, longer sentences are cut into `maxchar` pieces as
+    they grow, which keeps memory bounded on text without terminators.
+    '''
+
+    def __init__(self, maxchar=None):
+        self.maxchar = maxchar
+        self.reset()
+
+    def reset(self):
+        # unsettled separator at the end of the last chunk
+        self.tail = ''
+        # current sentence
+        self.parts = []
+        self.length = 0
+        # the current sentence ends with a separator
+        self.hassep = False
+        # the last piece ended at a separator
+        self.boundary = True
+
+    def _cut(self):
+        sent = ''.join(self.parts)
+        end = (len(sent) - 1) // self.maxchar * self.maxchar
+        self.parts = [sent[end:]]
+        self.length = len(sent) - end
+        return [sent[i:i + self.maxchar] for i in range(0, end, self.maxchar)]
+
+    def _split(self, text, final):
+        pieces = resentencesp.split(text)
+        # closing quotes or the lookahead of '：' may extend the last
+        # separator in the next chunk ('$' also matches before a newline)
+        if not final and len(pieces) > 1 and pieces[-1] in ('', '\n'):
+            self.tail = pieces.pop(-2) + pieces.pop()
+            # a trailing '：' may turn out not to be a separator
+            if pieces[-1] in ('：', '：\n'):
+                self.tail = pieces.pop() + self.tail
+            last = len(pieces)
+        else:
+            self.tail = ''
+            last = len(pieces) if final else len(pieces) - 1
+        result = []
+        maxchar = self.maxchar
+        parts = self.parts
+        for i, piece in enumerate(pieces):
+            if not piece:
+                continue
+            # splitsentence treats a whole piece of '：' as a separator
+            if i & 1 or (self.boundary and i < last and
+                         piece in ('：', '：\n')):
+                parts.append(piece)
+                self.hassep = True
+                self.boundary = True
+            else:
+                if self.hassep:
+                    result.append(''.join(parts))
+                    parts.clear()
+                    self.length = 0
+                    self.hassep = False
+                parts.append(piece)
+                self.boundary = False
+            self.length += len(piece)
+            if maxchar and self.length > maxchar:
+                result.extend(self._cut())
+                parts = self.parts
+        return result
+
+    def feed(self, chunk):
+        '''Add a chunk of text and return the completed sentences.'''
+        return self._split(self.tail + chunk, False)
+
+    def close(self):
+        '''Return the remaining sentences and reset the splitter.'''
+        result = self._split(self.tail, True)
+        if self.parts:
+            result.append(''.join(self.parts))
+        self.reset()
+        return result
+
+
+def splitstream(chunks, maxchar=None):
+    '''Split an iterable of text chunks into sentences.'''
+    splitter = SentenceSplitter(maxchar)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
 
 
 def splithard(sentence, maxchar=None):
@@ -133,11 +320,48 @@ def splithard(sentence, maxchar=None):
     return slist
 
 
+def fixmissingpos(s, start=0, end=None):
+    '''
+    Find where `fixmissing` splits s[start:end], or return None.
+
+    This gives the same result as matching `refixmissing`, in linear time.
+    '''
+    if end is None:
+        end = len(s)
+    # both alternatives need a closing quote
+    if not _RE_FM_CLOSE.search(s, start, end):
+        return None
+    # 1st alternative: text without quotes or punctuations, a closing quote
+    i = _RE_FM_NOTQUOTEPUNCT.match(s, start, end).end()
+    if (start < i < end and s[i] in _FM_CLOSE and
+            (i + 1 == end or s[i + 1] not in _FM_QUOTEPUNCT)):
+        return i + 1
+    # 2nd alternative: an optional opening quote, text without quotes
+    # containing a punctuation, text without opening quotes, a closing quote
+    textstart = start + 1 if start < end and s[start] in _FM_OPEN else start
+    textend = _RE_FM_NOTQUOTE.match(s, textstart, end).end()
+    if not _RE_FM_PUNCT.search(s, textstart + 1, textend):
+        return None
+    # the greedy match ends at the last acceptable closing quote
+    i = min(_RE_FM_NOTOPEN.match(s, textend, end).end(), end - 1)
+    while i >= textend:
+        if s[i] in _FM_CLOSE and (i + 1 == end or
+                                  s[i + 1] not in _FM_QUOTEPUNCT):
+            return i + 1
+        i -= 1
+    return None
+
+
 def fixmissing(slist):
     '''Fix missing quotes.'''
     newlist = []
     for i in slist:
-        newlist.extend(filter(None, refixmissing.split(i)))
+        pos = fixmissingpos(i)
+        if pos is not None and pos < len(i):
+            newlist.append(i[:pos])
+            newlist.append(i[pos:])
+        elif i:
+            newlist.append(i)
     return newlist
 
 
@@ -149,6 +373,37 @@ def filterlist(slist):
             yield s
 
 
+def fixmissingspans(s, spans):
+    '''Span version of `fixmissing`.'''
+    newspans = []
+    for start, end in spans:
+        if start >= end:
+            continue
+        pos = fixmissingpos(s, start, end)
+        if pos is not None and pos < end:
+            newspans.append((start, pos))
+            newspans.append((pos, end))
+        else:
+            newspans.append((start, end))
+    return newspans
+
+
+def filterspans(s, spans):
+    '''Span version of `filterlist`.'''
+    for start, end in spans:
+        while start < end and s[start] in _tailpunctset:
+            start += 1
+        while end > start and s[end - 1] in _headpunctset:
+            end -= 1
+        if end - start > 1:
+            yield (start, end)
+
+
+def slicespans(s, spans):
+    '''Get the substrings of the spans.'''
+    return [s[start:end] for start, end in spans]
+
+
 def addwalls(tokiter):
     '''Add walls between punctuations for Moses.'''
     lastwall = False
@@ -164,10 +419,17 @@ def addwalls(tokiter):
             lastwall = False
 
 
-def addwallzone(tokiter):
-    '''Add walls and zones between punctuations for Moses.'''
+def addwallzone(tokiter, out=None):
+    '''
+    Add walls and zones between punctuations for Moses.
+
+    If a list is given as `out`, it is cleared and reused for the result.
+    '''
     W = '<wall />'
-    out = []
+    if out is None:
+        out = []
+    else:
+        out.clear()
     expect = zidx = None
     for tok in tokiter:
         if tok in punct:
@@ -179,9 +441,9 @@ def addwallzone(tokiter):
                 out.append('</zone>')
                 expect = zidx = None
             else:
-                bid = openbrckt.find(tok)
-                if bid > -1:
-                    expect = clozbrckt[bid]
+                cloz = brcktpair.get(tok)
+                if cloz is not None:
+                    expect = cloz
                     zidx = len(out) - 1
                 out.append(tok)
                 out.append(W)
@@ -194,23 +456,141 @@ def addwallzone(tokiter):
     return out
 
 
-def calctxtstat(s):
-    '''Detect whether a string is modern or classical Chinese.'''
+ZHMODEL_START = 0x4E00
+ZHMODEL_END = 0x9FCD
+# magic, dtype ('d' or 'f'), number of items in each array
+ZHMODEL_HEADER = struct.Struct('<8sc3xI')
+ZHMODEL_MAGIC = b'NLPZHMDL'
+_zhmodel_arr = None
+
+
+def compilezhmodel(src=None, dst=None, dtype='d'):
+    '''
+    Compile modelzh.json into a binary file of two float arrays.
+
+    `dtype` is 'd' for float64 (exact scores) or 'f' for float32.
+    '''
+    import json
+    import array
+    src = src or os.path.join(_curpath, 'modelzh.json')
+    dst = dst or os.path.join(_curpath, 'modelzh.bin')
+    with open(src, 'r', encoding='utf-8') as f:
+        model = json.load(f)
+    zhc = array.array(dtype, model['zhc'])
+    zhm = array.array(dtype, model['zhm'])
+    if len(zhc) != len(zhm):
+        raise ValueError('zhc and zhm have different lengths')
+    if sys.byteorder != 'little':
+        zhc.byteswap()
+        zhm.byteswap()
+    with atomicwrite(dst) as f:
+        f.write(ZHMODEL_HEADER.pack(ZHMODEL_MAGIC, dtype.encode('ascii'), len(zhc)))
+        f.write(zhc.tobytes())
+        f.write(zhm.tobytes())
+
+
+def mapzhmodel(filename):
+    '''Memory-map a model compiled by `compilezhmodel` read-only.'''
+    if sys.byteorder != 'little':
+        raise ValueError('compiled model is little-endian')
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, dtype, count = ZHMODEL_HEADER.unpack_from(mm)
+    except struct.error:
+        raise ValueError('not a compiled model: %s' % filename)
+    dtype = dtype.decode('ascii', 'replace')
+    if magic != ZHMODEL_MAGIC or dtype not in 'df':
+        raise ValueError('not a compiled model: %s' % filename)
+    size = count * struct.calcsize(dtype)
+    start = ZHMODEL_HEADER.size
+    if len(mm) != start + size * 2:
+        raise ValueError('truncated model: %s' % filename)
+    mv = memoryview(mm)
+    return {
+        'zhc': mv[start:start + size].cast(dtype),
+        'zhm': mv[start + size:start + size * 2].cast(dtype)
+    }
+
+
+def loadzhmodel():
+    '''
+    Load the Classical/Modern Chinese model.
+
+    modelzh.json is the source of truth. It is compiled to modelzh.bin when
+    the binary is missing, older than the JSON or unreadable, and the
+    binary is memory-mapped so that forked workers share the pages.
+    '''
     global zhmodel
     if zhmodel is None:
-        import json
-        zhmodel = json.load(
-            open(os.path.join(_curpath, 'modelzh.json'), 'r', encoding='utf-8'))
+        src = os.path.join(_curpath, 'modelzh.json')
+        dst = os.path.join(_curpath, 'modelzh.bin')
+        try:
+            if (not os.path.isfile(dst) or
+                    os.path.getmtime(dst) < os.path.getmtime(src)):
+                compilezhmodel(src, dst)
+            try:
+                zhmodel = mapzhmodel(dst)
+            except ValueError:
+                # truncated or corrupt, compile it again once
+                compilezhmodel(src, dst)
+                zhmodel = mapzhmodel(dst)
+        except (OSError, ValueError):
+            import json
+            with open(src, 'r', encoding='utf-8') as f:
+                zhmodel = json.load(f)
+    return zhmodel
+
+
+def calctxtstat(s):
+    '''Detect whether a string is modern or classical Chinese.'''
+    model = loadzhmodel()
+    zhc = model['zhc']
+    zhm = model['zhm']
     cscore = 0
     mscore = 0
     for ch in s:
         ordch = ord(ch)
-        if 0x4E00 <= ordch < 0x9FCD:
-            cscore += zhmodel['zhc'][ordch - 0x4E00]
-            mscore += zhmodel['zhm'][ordch - 0x4E00]
+        if ZHMODEL_START <= ordch < ZHMODEL_END:
+            cscore += zhc[ordch - ZHMODEL_START]
+            mscore += zhm[ordch - ZHMODEL_START]
     return (cscore, mscore)
 
 
+def calctxtstat_batch(docs):
+    '''
+    Vectorized `calctxtstat` for a list of strings.
+
+    Returns an array of shape (len(docs), 2) holding (cscore, mscore) pairs.
+    Scores are accumulated in text order, so they equal `calctxtstat`
+    exactly. Falls back to a list of tuples if numpy is not available.
+    '''
+    try:
+        import numpy as np
+    except ImportError:
+        return [calctxtstat(s) for s in docs]
+    global _zhmodel_arr
+    if _zhmodel_arr is None:
+        model = loadzhmodel()
+        _zhmodel_arr = (np.asarray(model['zhc'], dtype=np.float64),
+                        np.asarray(model['zhm'], dtype=np.float64))
+    docs = docs if isinstance(docs, (list, tuple)) else list(docs)
+    n = len(docs)
+    lengths = np.fromiter(map(len, docs), dtype=np.intp, count=n)
+    cps = np.frombuffer(''.join(docs).encode('utf-32-le', 'surrogatepass'),
+                        dtype='<u4').astype(np.intp)
+    docid = np.repeat(np.arange(n), lengths)
+    cps -= ZHMODEL_START
+    mask = (cps >= 0) & (cps < ZHMODEL_END - ZHMODEL_START)
+    cps = cps[mask]
+    docid = docid[mask]
+    scores = np.empty((n, 2), dtype=np.float64)
+    # bincount adds weights sequentially, which keeps the summation order
+    scores[:, 0] = np.bincount(docid, _zhmodel_arr[0][cps], minlength=n)
+    scores[:, 1] = np.bincount(docid, _zhmodel_arr[1][cps], minlength=n)
+    return scores
+
+
 def checktxttype(cscore, mscore):
     if cscore > mscore:
         return 'c'
@@ -220,6 +600,53 @@ def checktxttype(cscore, mscore):
         return None
 
 
+def checktxttype_batch(scores):
+    '''Label all (cscore, mscore) pairs like `checktxttype`.'''
+    try:
+        import numpy as np
+    except ImportError:
+        return [checktxttype(c, m) for c, m in scores]
+    scores = np.asarray(scores, dtype=np.float64).reshape(-1, 2)
+    labels = np.full(len(scores), None, dtype=object)
+    labels[scores[:, 0] > scores[:, 1]] = 'c'
+    labels[scores[:, 0] < scores[:, 1]] = 'm'
+    return labels.tolist()
+
+
+_revuniq = lambda l: ''.join(k for k, g in itertools.groupby(reversed(l)))
+_n2c_groups = {}
+
+
+def _n2c_grouptable(c_basic, c_unit1, c_twoalt):
+    '''Renderings of all four-digit groups 0001-9999 for `num2chinese`.'''
+    key = (c_basic, c_unit1, c_twoalt)
+    table = _n2c_groups.get(key)
+    if table is not None:
+        return table
+    table = [c_basic[0]]
+    for num in range(1, 10000):
+        unit = '%04d' % num
+        ulist = []
+        for nc, ch in enumerate(reversed(unit)):
+            if ch == '0':
+                if ulist:  # ???0
+                    ulist.append(c_basic[0])
+            elif nc == 0:
+                ulist.append(c_basic[int(ch)])
+            elif nc == 1 and ch == '1' and unit[1] == '0':
+                # special case for tens
+                # edit the 'elif' if you don't like
+                # 十四, 三千零十四, 三千三百一十四
+                ulist.append(c_unit1[0])
+            elif nc > 1 and ch == '2':
+                ulist.append(c_twoalt + c_unit1[nc - 1])
+            else:
+                ulist.append(c_basic[int(ch)] + c_unit1[nc - 1])
+        table.append(_revuniq(ulist))
+    _n2c_groups[key] = table
+    return table
+
+
 def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
     """
     Converts numbers to Chinese representations.
@@ -253,7 +680,6 @@ def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
         else:
             c_twoalt = '二'
     c_unit2 = '万亿兆京垓秭穰沟涧正载' if simp else '萬億兆京垓秭穰溝澗正載'
-    revuniq = lambda l: ''.join(k for k, g in itertools.groupby(reversed(l)))
     nd = str(num)
     result = []
     if nd[0] == '+':
@@ -267,38 +693,20 @@ def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
     if int(integer):
         splitted = [integer[max(i - 4, 0):i]
                     for i in range(len(integer), 0, -4)]
+        groups = _n2c_grouptable(c_basic, c_unit1, c_twoalt)
         intresult = []
         for nu, unit in enumerate(splitted):
+            unit = int(unit)
             # special cases
-            if int(unit) == 0:  # 0000
+            if unit == 0:  # 0000
                 intresult.append(c_basic[0])
-                continue
-            elif nu > 0 and int(unit) == 2:  # 0002
+            elif nu > 0 and unit == 2:  # 0002
                 intresult.append(c_twoalt + c_unit2[nu - 1])
-                continue
-            ulist = []
-            unit = unit.zfill(4)
-            for nc, ch in enumerate(reversed(unit)):
-                if ch == '0':
-                    if ulist:  # ???0
-                        ulist.append(c_basic[0])
-                elif nc == 0:
-                    ulist.append(c_basic[int(ch)])
-                elif nc == 1 and ch == '1' and unit[1] == '0':
-                    # special case for tens
-                    # edit the 'elif' if you don't like
-                    # 十四, 三千零十四, 三千三百一十四
-                    ulist.append(c_unit1[0])
-                elif nc > 1 and ch == '2':
-                    ulist.append(c_twoalt + c_unit1[nc - 1])
-                else:
-                    ulist.append(c_basic[int(ch)] + c_unit1[nc - 1])
-            ustr = revuniq(ulist)
-            if nu == 0:
-                intresult.append(ustr)
+            elif nu == 0:
+                intresult.append(groups[unit])
             else:
-                intresult.append(ustr + c_unit2[nu - 1])
-        result.append(revuniq(intresult).strip(c_basic[0]))
+                intresult.append(groups[unit] + c_unit2[nu - 1])
+        result.append(_revuniq(intresult).strip(c_basic[0]))
     else:
         result.append(c_basic[0])
     if remainder:
@@ -308,12 +716,47 @@ def num2chinese(num, big=False, simp=True, o=False, twoalt=False):
 
 
 stripquotes = lambda s: s.lstrip('"‘“「『').rstrip('"’”」』')
-fw2hw = lambda s: ''.join(
-    (chr(ord(ch) - 0xFEE0) if ord(ch) in fullwidth else ch) for ch in s)
+_fw2hw_table = {cp: cp - 0xFEE0 for start, end in fullwidthranges
+                for cp in range(start, end + 1)}
+fw2hw = lambda s: s.translate(_fw2hw_table)
 hw2fw = lambda s: ''.join(
     (chr(ord(ch) + 0xFEE0) if ch in halfwidth else ch) for ch in s)
 
 
+def makenormalizer(fw2hw=True, removectrl=True, gbkpua=True, detokenize=True):
+    '''
+    Make a function that does the chosen cleanup steps in one go.
+
+    The result is the same as applying `fw2hw`, `removectrl`,
+    `gbk_pua.gbk_pua_convert` and `detokenize` in this order. The character
+    mappings are composed into one `str.translate` table, followed by at
+    most one regex pass.
+    '''
+    steps = []
+    if fw2hw:
+        steps.append(_fw2hw_table)
+    if removectrl:
+        steps.append(dict.fromkeys(itertools.chain(range(0x20), (0xFEFF,))))
+    if gbkpua:
+        from gbk_pua import gbk_table
+        steps.append(gbk_table)
+    table = {}
+    for cp in set().union(*steps):
+        ch = chr(cp)
+        for step in steps:
+            ch = ch.translate(step)
+        if ch != chr(cp):
+            table[cp] = ch
+    if detokenize:
+        if table:
+            return lambda s: RE_WS_IN_FW.sub(r'\1', s.translate(table)).strip()
+        return lambda s: RE_WS_IN_FW.sub(r'\1', s).strip()
+    elif table:
+        return lambda s: s.translate(table)
+    else:
+        return lambda s: s
+
+
 def _test_fixsplit():
     test = """从高祖父到曾孙称为“九族”。这“九族”代表着长幼尊卑秩序和家族血统的承续关系。
 《诗》、《书》、《易》、《礼》、《春秋》，再加上《乐》称“六经”，这是中国古代儒家的重要经典，应当仔细阅读。
@@ -328,8 +771,28 @@ def _test_fixsplit():
     for s in test:
         print(fixmissing(splitsentence(s)))
 
+def _test_fixmissing(n=100000, size=100000):
+    '''Check `fixmissingpos` against `refixmissing`, then time bad cases.'''
+    import time
+    import random
+    alphabet = '"‘“「『’”」』，；。！？我 '
+    for _ in range(n):
+        s = ''.join(random.choice(alphabet)
+                    for _ in range(random.randint(0, 16)))
+        m = refixmissing.match(s)
+        assert fixmissingpos(s) == (m and m.end()), s
+    # these take quadratic time with refixmissing
+    for s in ('，' * size + '”，',
+              '我，' * size + '”' * size + '，',
+              '“' + '我，' * size + '”' * size + '“',
+              '我' * size + '，' * size + '」' * size):
+        t = time.perf_counter()
+        fixmissing([s])
+        print('%d chars: %.4fs' % (len(s), time.perf_counter() - t))
+
+
 if __name__ == '__main__':
-    import sys
     _test_fixsplit()
+    _test_fixmissing()
     print(' '.join(addwallzone('《连山》、《归藏》、《周易》，是我国古代的三部书，这三部书合称“三易”，“三易”是用“卦”的形式来说明(宇宙间万事万物循环变化的道理的书籍。')))
     # print(checktxttype(sys.stdin.read()))